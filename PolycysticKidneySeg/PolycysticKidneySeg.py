@@ -84,6 +84,12 @@ class PolycysticKidneySegWidget(ScriptedLoadableModuleWidget):
         self.widget = Widget(SegmentationLogic(), InstallLogic())
         self.layout.addWidget(self.widget)
 
+    def cleanup(self) -> None:
+        """Called when the application closes and the module widget is destroyed."""
+        if self.widget is not None:
+            self.widget.onCancel()
+            self.widget.logic.releaseModels()
+
 
 class PolycysticKidneySegTest(ScriptedLoadableModuleTest):
     def runTest(self):
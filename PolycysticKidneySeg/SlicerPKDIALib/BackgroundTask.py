@@ -0,0 +1,93 @@
+import queue
+import threading
+
+from .Signal import Signal
+
+
+class BackgroundTask:
+    """
+    Runs function(*args, progressCallback=..., cancelEvent=..., **kwargs) in a worker thread.
+
+    Progress, result and errors of the worker are queued and only emitted by poll, on the thread calling it (e.g. from a
+    Qt timer on the main thread), so that connected slots can safely update the MRML scene and the UI. The optional
+    then callable is applied to the result on the polling thread before finished is emitted.
+
+    The worker may also post intermediate results with postPartialResult, emitted by partialResult after the optional
+    thenPartial callable.
+    """
+
+    def __init__(self, function, *args, then=None, thenPartial=None, **kwargs):
+        self.progress = Signal("int", "int")
+        self.partialResult = Signal("object")
+        self.finished = Signal("object")
+        self.failed = Signal("Exception")
+        self.cancelled = Signal()
+
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._then = then
+        self._thenPartial = thenPartial
+        self._cancelEvent = threading.Event()
+        self._messages = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._isDone = False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelEvent.set()
+
+    def isCancelRequested(self):
+        return self._cancelEvent.is_set()
+
+    def isDone(self):
+        return self._isDone
+
+    def postPartialResult(self, result):
+        """Queues an intermediate result of the worker, to be emitted by the next poll."""
+        self._messages.put((self.partialResult, (result,)))
+
+    def _run(self):
+        try:
+            result = self._function(
+                *self._args,
+                progressCallback=lambda *progress: self._messages.put((self.progress, progress)),
+                cancelEvent=self._cancelEvent,
+                **self._kwargs,
+            )
+            self._messages.put((self.finished, (result,)))
+        except Exception as e:  # noqa
+            if self._cancelEvent.is_set():
+                self._messages.put((self.cancelled, ()))
+            else:
+                self._messages.put((self.failed, (e,)))
+
+    def poll(self):
+        """
+        Emits the pending worker messages. Returns False once the task is done and its last signal was emitted.
+        """
+        while not self._isDone:
+            try:
+                signal, args = self._messages.get_nowait()
+            except queue.Empty:
+                break
+
+            then = {self.finished: self._then, self.partialResult: self._thenPartial}.get(signal)
+            if then is not None:
+                try:
+                    args = (then(*args),)
+                except Exception as e:  # noqa
+                    signal, args = self.failed, (e,)
+                    self.cancel()  # the worker may still be running after a failed partial result
+
+            self._isDone = signal not in (self.progress, self.partialResult)
+            signal.emit(*args)
+        return not self._isDone
+
+    def wait(self, timeout=None):
+        """Blocks until the worker ends, then emits its pending messages."""
+        self._thread.join(timeout)
+        return self.poll()
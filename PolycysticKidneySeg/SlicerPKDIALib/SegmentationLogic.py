@@ -1,7 +1,12 @@
 from pathlib import Path
 
+import numpy as np
+import qt
 import slicer
+import vtk
 
+from .BackgroundTask import BackgroundTask
+from .pkdia.profiling import activated, profileStage
 from .pkdia.utils.modality import ModalityEnum
 
 
@@ -16,25 +21,262 @@ class SegmentationLogic:
 
         self.segmentColors = [(0.7, 0.4, 0.3), (0.8, 0.3, 0.3)]
 
+        self._models = None
+        self._resultCache = None
+        self._pollTimer = None
+
+        # (volume node ID, modality, precision, segmentation node ID) and IncrementalSegmentation of the last
+        # segmentation in background, updated when the same volume is segmented again into the same node
+        self._lastSegmentation = None
+
+    @property
+    def models(self):
+        """
+        Networks kept in memory between segmentations, the least recently used ones being released first.
+        Created on first use as torch may not be installed when the module is loaded.
+        """
+        if self._models is None:
+            from .pkdia.nets.registry import ModelRegistry
+
+            self._models = ModelRegistry(maxSize=len(ModalityEnum))
+        return self._models
+
+    @property
+    def resultCache(self):
+        """
+        Predictions of the volumes already segmented, kept in the Slicer cache directory so that segmenting them again
+        skips inference.
+        """
+        if self._resultCache is None:
+            from .pkdia.cache import ResultCache
+
+            self._resultCache = ResultCache(Path(slicer.app.cachePath) / "PKDIA")
+        return self._resultCache
+
     def areWeightsFound(self):
         for weightPath in self.weightsPaths.values():
             if not weightPath.exists():
                 return False
         return True
 
-    def applySegmentation(self, inputFilePath, outputFolder, modality):
+    def applySegmentation(
+        self, inputFilePath, outputFolder, modality, batchSize="auto", localizerStride=None, precision="fp32"
+    ):
         from .pkdia.PKDIA import applyPKDIA
 
         weightsPath = self.weightsPaths[modality]
-        predLKPath, predRKPath, _, _ = applyPKDIA(inputFilePath, outputFolder, modality, weightsPath)
+        net = self.models.get(modality, weightsPath, dtype=precision)
+        predLKPath, predRKPath, _, _ = applyPKDIA(
+            inputFilePath,
+            outputFolder,
+            modality,
+            weightsPath,
+            batchSize=batchSize,
+            net=net,
+            localizerStride=localizerStride,
+            precision=precision,
+            cache=self.resultCache,
+        )
         return self.generateSegmentationNodes(predLKPath, predRKPath)
 
+    def applySegmentationToVolume(self, volumeNode, modality, batchSize="auto", localizerStride=None, precision="fp32"):
+        """
+        Segments the kidneys of volumeNode in memory, without writing the volume nor the predictions to disk.
+        """
+        from .pkdia.PKDIA import applyPKDIAArray
+
+        weightsPath = self.weightsPaths[modality]
+        net = self.models.get(modality, weightsPath, dtype=precision)
+
+        # Slicer arrays are indexed (k, j, i), transposed views are indexed like the IJK to RAS matrix
+        array = slicer.util.arrayFromVolume(volumeNode).T
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        array_LK, array_RK = applyPKDIAArray(
+            array,
+            slicer.util.arrayFromVTKMatrix(ijkToRas),
+            modality,
+            weightsPath,
+            batchSize=batchSize,
+            net=net,
+            localizerStride=localizerStride,
+            precision=precision,
+            cache=self.resultCache,
+        )
+        return self.generateSegmentationNodeFromArrays(array_LK.T, array_RK.T, volumeNode)
+
+    def applySegmentationToVolumeInBackground(
+        self,
+        volumeNode,
+        modality,
+        batchSize="auto",
+        localizerStride=None,
+        precision="fp32",
+        pollIntervalMs=100,
+        segmentationNode=None,
+        region=None,
+        previewStride=4,
+        profiler=None,
+    ):
+        """
+        Non-blocking applySegmentationToVolume : the network is loaded and applied in a worker thread while the Qt event
+        loop keeps running. Returns the started BackgroundTask, whose progress signal reports the segmented slices and
+        whose finished signal carries the segmentation node, created on the main thread.
+
+        If segmentationNode is given, it is updated in place instead. When it holds the last segmentation of volumeNode,
+        only the slices whose voxels changed since then, or holding voxels of region (an index expression of the
+        (k, j, i) volume array), are segmented again. Not available with the localizer, which may skip slices.
+
+        When the whole volume is segmented without the localizer, a preview interpolated from one slice every
+        previewStride slices is shown first, then refined as the other slices are segmented : the partialResult signal
+        carries the segmentation node after each update, removed again if it was created and the task does not finish.
+
+        profiler, a pkdia.profiling.Profiler, records the stages of the segmentation, Slicer import included.
+        """
+        from .pkdia.incremental import IncrementalSegmentation
+        from .pkdia.PKDIA import applyPKDIAArray
+
+        # Copied as the volume may be modified by the user during the segmentation
+        array = slicer.util.arrayFromVolume(volumeNode).T.copy()
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        ijkToRas = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        weightsPath = self.weightsPaths[modality]
+        cache = self.resultCache
+
+        if localizerStride is not None:
+
+            def segment(progressCallback, cancelEvent):
+                with activated(profiler):
+                    net = self.models.get(modality, weightsPath, dtype=precision)
+                    arrays = applyPKDIAArray(
+                        array,
+                        ijkToRas,
+                        modality,
+                        weightsPath,
+                        batchSize=batchSize,
+                        net=net,
+                        progressCallback=progressCallback,
+                        cancelEvent=cancelEvent,
+                        localizerStride=localizerStride,
+                        precision=precision,
+                        cache=cache,
+                    )
+                return (*arrays, (True, True))
+
+            session = None
+        else:
+            # Segmentations are kept for the last volume only, as sessions hold its masks and labels
+            session = None
+            if segmentationNode is not None and self._lastSegmentation is not None:
+                lastKey, lastSession = self._lastSegmentation
+                if lastKey == (volumeNode.GetID(), modality, precision, segmentationNode.GetID()):
+                    session = lastSession
+            if session is None:
+                session = IncrementalSegmentation(modality, None, weightsPath, batchSize, precision, cache)
+            session.batchSize = batchSize
+            if region is not None:
+                # Slicer regions index the (k, j, i) array, sessions its (i, j, k) transpose
+                regionMask = np.zeros(array.shape[::-1], dtype=bool)
+                regionMask[region] = True
+                region = regionMask.T
+
+            def segment(progressCallback, cancelEvent):
+                with activated(profiler):
+                    session.net = self.models.get(modality, weightsPath, dtype=precision)
+                    return session.segment(
+                        array,
+                        ijkToRas,
+                        region,
+                        progressCallback,
+                        cancelEvent,
+                        previewStride,
+                        previewCallback=lambda *arrays: task.postPartialResult(arrays),
+                    )
+
+        isNewNode = segmentationNode is None
+
+        def updatePreviewNode(arrays):
+            nonlocal segmentationNode
+            array_LK, array_RK = arrays
+            with activated(profiler):
+                segmentationNode = self.generateSegmentationNodeFromArrays(
+                    array_LK.T, array_RK.T, volumeNode, segmentationNode
+                )
+            return segmentationNode
+
+        def removePreviewNode(*_):
+            if isNewNode and segmentationNode is not None:
+                slicer.mrmlScene.RemoveNode(segmentationNode)
+
+        def updateSegmentationNode(result):
+            array_LK, array_RK, changed = result
+            with activated(profiler):
+                node = self.generateSegmentationNodeFromArrays(
+                    array_LK.T, array_RK.T, volumeNode, segmentationNode, changed
+                )
+            if session is not None:
+                self._lastSegmentation = ((volumeNode.GetID(), modality, precision, node.GetID()), session)
+            return node
+
+        task = BackgroundTask(segment, then=updateSegmentationNode, thenPartial=updatePreviewNode)
+        task.failed.connect(removePreviewNode)
+        task.cancelled.connect(removePreviewNode)
+        self._startPolling(task, pollIntervalMs)
+        return task.start()
+
+    def _startPolling(self, task, pollIntervalMs):
+        if self._pollTimer is not None:
+            self._pollTimer.stop()
+        timer = qt.QTimer()
+        timer.setInterval(pollIntervalMs)
+
+        def poll():
+            if not task.poll():
+                timer.stop()
+
+        timer.timeout.connect(poll)
+        timer.start()
+        self._pollTimer = timer
+
+    def releaseModels(self):
+        if self._models is not None:
+            self._models.release()
+
     def generateSegmentationNodes(self, predLKPath, predRKPath):
-        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "PKDIASegmentation")
-        segmentationNode.CreateDefaultDisplayNodes()
+        with profileStage("Slicer import"):
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "PKDIASegmentation")
+            segmentationNode.CreateDefaultDisplayNodes()
+
+            self._loadSegment(predLKPath, segmentationNode, self.segmentColors[0], "Left Kidney", "Segment_1")
+            self._loadSegment(predRKPath, segmentationNode, self.segmentColors[1], "Right Kidney", "Segment_2")
+
+        return segmentationNode
+
+    def generateSegmentationNodeFromArrays(
+        self, array_LK, array_RK, referenceVolumeNode, segmentationNode=None, changed=(True, True)
+    ):
+        """
+        Creates the PKDIA segmentation node from left and right kidney label arrays indexed (k, j, i) like the
+        reference volume node. If segmentationNode is given, its kidney segments are updated in place instead, only
+        where changed is True.
+        """
+        with profileStage("Slicer import"):
+            if segmentationNode is None:
+                segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "PKDIASegmentation")
+                segmentationNode.CreateDefaultDisplayNodes()
+                segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
 
-        self._loadSegment(predLKPath, segmentationNode, self.segmentColors[0], "Left Kidney", "Segment_1")
-        self._loadSegment(predRKPath, segmentationNode, self.segmentColors[1], "Right Kidney", "Segment_2")
+            segmentation = segmentationNode.GetSegmentation()
+            segments = [(array_LK, "Left Kidney", "Segment_1"), (array_RK, "Right Kidney", "Segment_2")]
+            for (array, segmentName, segmentID), segmentColor, isChanged in zip(segments, self.segmentColors, changed):
+                if segmentation.GetSegment(segmentID) is None:
+                    segmentation.AddEmptySegment(segmentID, segmentName, segmentColor)
+                elif not isChanged:
+                    continue
+                slicer.util.updateSegmentBinaryLabelmapFromArray(
+                    array, segmentationNode, segmentID, referenceVolumeNode
+                )
 
         return segmentationNode
 
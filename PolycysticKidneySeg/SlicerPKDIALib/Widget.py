@@ -1,4 +1,3 @@
-import tempfile
 import traceback
 from pathlib import Path
 import urllib
@@ -8,6 +7,7 @@ import qt
 import slicer
 from slicer.i18n import tr as _  # noqa
 
+from .pkdia.profiling import Profiler
 from .pkdia.utils.modality import ModalityEnum
 
 
@@ -18,6 +18,10 @@ class Widget(qt.QWidget):
         self.logic = segmentationLogic
         self.installLogic = installLogic
         self._doShowErrorWindows = doShowInfoWindows
+        self.segmentationTask = None
+        self._segmentationInput = None  # (volume node, modality) of the running segmentation
+        self.lastSegmentation = None  # (volume node, modality, segmentation node) of the last segmentation
+        self.profiler = None  # stages of the running or last segmentation
 
         self.installLogic.progressInfo.connect(self.onProgressInfo)
 
@@ -36,6 +40,7 @@ class Widget(qt.QWidget):
         self.ui.installButton.pressed.connect(self.onInstall)
         self.ui.weightsButton.pressed.connect(self.onWeightsDownload)
         self.ui.applyButton.pressed.connect(self.onApply)
+        self.ui.cancelButton.pressed.connect(self.onCancel)
         self.ui.inputVolumeComboBox.setMRMLScene(slicer.mrmlScene)
 
     @staticmethod
@@ -73,7 +78,7 @@ class Widget(qt.QWidget):
 
         weightURLs = {
             ModalityEnum.T2: "https://github.com/conze/SlicerPolycysticKidneySeg/releases/download/v.1.1.0/PKDIAv1-weights.pth",
-            ModalityEnum.CT: "https://github.com/conze/SlicerPolycysticKidneySeg/releases/download/v.1.1.0/PKDIAv2-weights.pth"
+            ModalityEnum.CT: "https://github.com/conze/SlicerPolycysticKidneySeg/releases/download/v.1.1.0/PKDIAv2-weights.pth",
         }
         success = True
         for modality in ModalityEnum:
@@ -143,18 +148,77 @@ class Widget(qt.QWidget):
             errorMessage = f"Could not find weights at {self.logic.weightsDir}. Please download them."
         if errorMessage is not None:
             self._reportError(errorMessage)
-        else:
-            try:
-                with tempfile.TemporaryDirectory() as tempDirPath:
-                    inputFileName = "volume.nii.gz"
-                    inputFilePath = Path(tempDirPath) / inputFileName
-                    slicer.util.saveNode(inputVolume, str(inputFilePath))
-                    self.onProgressInfo("Loading inference results...")
-                    segmentationNode = self.logic.applySegmentation(str(inputFilePath), tempDirPath, modality)
-                    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
-                    self._reportFinished("Inference ended successfully.")
-            except RuntimeError as e:
-                self._reportError(f"Inference ended in error:\n{e}")
+            self._setButtonsEnabled(True)
+            return
+
+        self.onProgressInfo("Loading inference results...")
+        self.ui.progressBar.setValue(0)
+        segmentationNode = self.lastSegmentationNode(inputVolume, modality)
+        if segmentationNode is not None:
+            self.onProgressInfo(f"Updating {segmentationNode.GetName()}, only modified slices are segmented again")
+        self._segmentationInput = (inputVolume, modality)
+        self.profiler = Profiler()
+        self.segmentationTask = self.logic.applySegmentationToVolumeInBackground(
+            inputVolume, modality, segmentationNode=segmentationNode, profiler=self.profiler
+        )
+        self.segmentationTask.progress.connect(self.onSegmentationProgress)
+        self.segmentationTask.partialResult.connect(self.onSegmentationPreview)
+        self.segmentationTask.finished.connect(self.onSegmentationFinished)
+        self.segmentationTask.failed.connect(self.onSegmentationFailed)
+        self.segmentationTask.cancelled.connect(self.onSegmentationCancelled)
+        self.ui.cancelButton.setEnabled(True)
+
+    def lastSegmentationNode(self, volumeNode, modality):
+        """segmentation node of the last segmentation of volumeNode with modality, if still in the scene"""
+        if self.lastSegmentation is None:
+            return None
+        lastVolumeNode, lastModality, segmentationNode = self.lastSegmentation
+        if lastVolumeNode.GetID() != volumeNode.GetID() or lastModality != modality:
+            return None
+        return segmentationNode if slicer.mrmlScene.IsNodePresent(segmentationNode) else None
+
+    def isSegmentationRunning(self):
+        return self.segmentationTask is not None and not self.segmentationTask.isDone()
+
+    def onCancel(self):
+        if self.isSegmentationRunning():
+            self.onProgressInfo("Cancelling...")
+            self.segmentationTask.cancel()
+            self.ui.cancelButton.setEnabled(False)
+
+    def onSegmentationProgress(self, segmentedSlices, slices):
+        self.ui.progressBar.setMaximum(slices)
+        self.ui.progressBar.setValue(segmentedSlices)
+
+    def onSegmentationPreview(self, segmentationNode):
+        self.onProgressInfo(f"Preview updated in {segmentationNode.GetName()}, segmenting the remaining slices...")
+
+    def onSegmentationFinished(self, segmentationNode):
+        self.lastSegmentation = (*self._segmentationInput, segmentationNode)
+        self.reportProfile()
+        self._reportFinished("Inference ended successfully.")
+        self._endSegmentation()
+
+    def reportProfile(self):
+        """logs the stages of the last segmentation, also written as JSON to the Slicer temporary directory"""
+        self.profiler.close()
+        profilePath = Path(slicer.app.temporaryPath) / "PKDIA-profile.json"
+        self.profiler.writeJson(profilePath)
+        self.onProgressInfo(self.profiler.summary())
+        self.onProgressInfo(f"Profile written to {profilePath}")
+
+    def onSegmentationFailed(self, error):
+        errorMessage = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        self._reportError(f"Inference ended in error:\n{error}", doTraceback=False)
+        self.onProgressInfo(errorMessage)
+        self._endSegmentation()
+
+    def onSegmentationCancelled(self):
+        self.onProgressInfo("Inference cancelled.")
+        self._endSegmentation()
+
+    def _endSegmentation(self):
+        self.ui.cancelButton.setEnabled(False)
         self._setButtonsEnabled(True)
 
     def getInputVolume(self):
@@ -4,111 +4,368 @@ import os
 import nibabel
 import numpy as np
 import torch
-from skimage.transform import resize, rotate
-from torch.utils.data import DataLoader
+from nibabel.orientations import apply_orientation, io_orientation, ornt_transform
 
+from .cache import resultKey
 from .datasets.dataset_genkyst import tiny_dataset_genkyst_prod
-from .nets import swinv2Unet
-from .utils.utils import get_array_affine_header, getLargestConnectedArea, prob2mask
+from .nets.registry import IMG_SIZE, loadPKDIANet
+from .profiling import profileStage
+from .utils.utils import (
+    auto_batch_size,
+    get_array_affine_header,
+    getLargestConnectedArea,
+    masks2slices,
+    prob2mask,
+)
 
 
-def applyPKDIA(inputPath, outputDir, modality, weightsPath, verbose=False):
+class InferenceCancelledError(RuntimeError):
+    pass
+
+
+def _loadNet(net, weightsPath, verbose, precision="fp32"):
+    if net is None:
+        net = loadPKDIANet(weightsPath, dtype=precision)
+
+    if verbose:
+        logging.info(f"using device {next(net.parameters()).device}")
+        logging.info("model loaded !")
+    return net
+
+
+def _localizedSlices(array_LK, array_RK, coarseSlices, stride, margin):
+    """
+    Slices not segmented by the coarse pass that may hold kidneys : within stride - 1 + margin slices of a coarse slice
+    with a kidney. Every remaining slice if the coarse pass found none.
+    """
+    nSlices = array_LK.shape[1]
+    hasKidney = array_LK[:, coarseSlices, :].any(axis=(0, 2)) | array_RK[:, coarseSlices, :].any(axis=(0, 2))
+    if not hasKidney.any():
+        first, stop = 0, nSlices
+    else:
+        first = max(coarseSlices[hasKidney][0] - (stride - 1) - margin, 0)
+        stop = min(coarseSlices[hasKidney][-1] + stride + margin, nSlices)
+    return np.setdiff1d(np.arange(first, stop), coarseSlices)
+
+
+def _interpolatedProbabilities(coarseMaps, coarseSlices, slices):
+    """
+    (2, len(slices), size, size) probability maps of slices, linearly interpolated between the coarseMaps of the coarse
+    slices around them, or copied from the last coarse slice after it.
+    """
+    upper = np.minimum(np.searchsorted(coarseSlices, slices), len(coarseSlices) - 1)
+    lower = np.maximum(upper - 1, 0)
+    weights = (slices - coarseSlices[lower]) / np.maximum(coarseSlices[upper] - coarseSlices[lower], 1)
+    weights = np.clip(weights, 0, 1).astype(np.float32)[None, :, None, None]
+    lowerMaps = coarseMaps[:, lower].astype(np.float32)
+    return lowerMaps + weights * (coarseMaps[:, upper] - lowerMaps)
+
+
+def predictPKDIA(
+    test_dataset,
+    net,
+    batchSize="auto",
+    verbose=False,
+    progressCallback=None,
+    cancelEvent=None,
+    images=None,
+    localizerStride=None,
+    localizerMargin=2,
+    slices=None,
+    out=None,
+    probabilities=None,
+    previewStride=None,
+    previewCallback=None,
+):
+    """
+    Runs net on every coronal slice of the dataset exam.
+    Returns the left and right kidney masks before post-processing, in the exam volume space.
+
+    :param progressCallback: called with the number of segmented slices and the total number of slices after each batch
+    :param cancelEvent: threading.Event, InferenceCancelledError is raised before the next batch once it is set
+    :param images: test_dataset.images(), if already computed
+    :param localizerStride: if set, a coarse pass first segments one slice every localizerStride slices. The other slices
+        are only segmented around the coarse slices holding kidneys, with localizerMargin extra slices on each side, the
+        remaining ones being left empty
+    :param slices: if set, only these coronal slices are preprocessed and segmented, the localizer being ignored
+    :param out: (array_LK, array_RK) masks of a previous prediction, updated in place instead of new ones
+    :param probabilities: (2, slices, size, size) array receiving the left and right kidney probability maps of the
+        segmented slices, at the network resolution
+    :param previewStride: if set with previewCallback, one slice every previewStride slices is segmented first and the
+        masks of the other slices are interpolated from their probability maps. previewCallback(array_LK, array_RK) is
+        then called with these preview masks, and again with the refined ones after each quarter of the remaining
+        slices is segmented. The arrays are the returned ones, updated in place afterwards. Ignored with the localizer
+        or slices
+    """
+    device, dtype = next(net.parameters()).device, next(net.parameters()).dtype
+    if batchSize == "auto":
+        batchSize = auto_batch_size(device)
+
+    if verbose:
+        logging.info(f"using batches of {batchSize} slices")
+
+    if out is not None:
+        array_LK, array_RK = out
+    else:
+        array_LK, _, _ = get_array_affine_header(test_dataset)
+        array_RK = array_LK.copy()
+
+    sliceShape = (test_dataset.exam.volume.shape[0], test_dataset.exam.volume.shape[2])
+    firstSlice = 0
+    if images is not None:
+        volume = images
+    elif slices is not None:
+        firstSlice = int(np.min(slices)) if len(slices) else 0
+        volume = test_dataset.images(firstSlice, int(np.max(slices)) + 1) if len(slices) else None
+    else:
+        volume = test_dataset.images()  # every slice is preprocessed at once
+    nSlices = len(test_dataset) if slices is None else len(slices)
+    segmentedSlices = 0
+
+    isPreview = previewCallback is not None and previewStride is not None and previewStride > 1
+    isPreview = isPreview and slices is None and (localizerStride is None or localizerStride <= 1)
+    if isPreview:
+        coarseSlices = np.arange(0, nSlices, previewStride)
+        coarseMaps = np.empty((2, len(coarseSlices), *volume.shape[-2:]), dtype=np.float16)
+
+    def writeSlices(batch, probs_LK, probs_RK):
+        masks_LK, masks_RK = prob2mask(probs_LK), prob2mask(probs_RK)
+        # coronal slices are stored upside down in the volume : write the whole batch with a single flip
+        array_LK[:, batch, :] = masks2slices(masks_LK, sliceShape)[:, ::-1, :].transpose(1, 0, 2)
+        array_RK[:, batch, :] = masks2slices(masks_RK, sliceShape)[:, ::-1, :].transpose(1, 0, 2)
+
+    def segmentSlices(indices, maps=None):
+        """segments the slices of indices, writing their probability maps to maps[:, i] for indices[i] if given"""
+        nonlocal segmentedSlices
+        for start in range(0, len(indices), batchSize):
+            if cancelEvent is not None and cancelEvent.is_set():
+                raise InferenceCancelledError("Inference cancelled")
+            batch = indices[start : start + batchSize]
+            images = volume[torch.as_tensor(batch - firstSlice)].to(device=device, dtype=dtype)
+
+            # reduced precision networks keep the numerically sensitive operations in float32
+            with profileStage("forward"), torch.autocast(device.type, dtype=dtype, enabled=dtype != torch.float32):
+                logits_LK, logits_RK = net(images)  # both decoders share a single encoder pass
+            with profileStage("post-process"):
+                probs_LK, probs_RK = torch.sigmoid(logits_LK.float()), torch.sigmoid(logits_RK.float())
+                if probabilities is not None or maps is not None:
+                    batchMaps = np.stack([probs_LK.squeeze(1).cpu().numpy(), probs_RK.squeeze(1).cpu().numpy()])
+                    if probabilities is not None:
+                        probabilities[:, batch] = batchMaps
+                    if maps is not None:
+                        maps[:, start : start + len(batch)] = batchMaps
+                writeSlices(batch, probs_LK, probs_RK)
+
+            segmentedSlices += len(batch)
+            if progressCallback is not None:
+                progressCallback(segmentedSlices, nSlices)
+
+    with torch.no_grad():
+        if slices is not None:
+            segmentSlices(np.asarray(slices, dtype=np.int64))
+        elif isPreview:
+            segmentSlices(coarseSlices, coarseMaps)
+            remainingSlices = np.setdiff1d(np.arange(nSlices), coarseSlices)
+            with profileStage("post-process"):
+                for start in range(0, len(remainingSlices), batchSize):
+                    batch = remainingSlices[start : start + batchSize]
+                    probs = _interpolatedProbabilities(coarseMaps, coarseSlices, batch)
+                    writeSlices(batch, *torch.from_numpy(probs).unsqueeze(2))
+            previewCallback(array_LK, array_RK)
+
+            quarters = [quarter for quarter in np.array_split(remainingSlices, 4) if len(quarter)]
+            for quarter in quarters:
+                segmentSlices(quarter)
+                if quarter is not quarters[-1]:
+                    previewCallback(array_LK, array_RK)
+        elif localizerStride is None or localizerStride <= 1:
+            segmentSlices(np.arange(nSlices))
+        else:
+            coarseSlices = np.arange(0, nSlices, localizerStride)
+            segmentSlices(coarseSlices)
+            segmentSlices(_localizedSlices(array_LK, array_RK, coarseSlices, localizerStride, localizerMargin))
+
+            skippedSlices = nSlices - segmentedSlices
+            logging.info(f"localizer skipped {skippedSlices} of {nSlices} coronal slices")
+            if skippedSlices and progressCallback is not None:
+                progressCallback(nSlices, nSlices)
+
+    return array_LK, array_RK
+
+
+def _predictWithCache(test_dataset, cache, weightsPath, precision, localizerStride, progressCallback, predict):
+    """
+    Masks of predict(), read from cache instead when it holds the ones of the exam, then added to it.
+    The cache is only used with weightsPath, needed to key the predictions.
+    """
+    if cache is None or weightsPath is None:
+        return predict()
+
+    key = resultKey(test_dataset, test_dataset.modality, weightsPath, precision, localizerStride)
+    masks = cache.get(key)
+    if masks is None:
+        masks = predict()
+        cache.put(key, *masks)
+    elif progressCallback is not None:
+        progressCallback(len(test_dataset), len(test_dataset))
+    return masks
+
+
+def postprocessPKDIA(array_LK, array_RK, out=None):
+    """
+    Keeps the largest connected component of each kidney mask.
+    Returns the uint8 left kidney, right kidney and union label volumes, the union being written to out if given.
+    """
+    array_LK = getLargestConnectedArea(array_LK)
+    array_RK = getLargestConnectedArea(array_RK)
+    with profileStage("post-process"):
+        array = out if out is not None else np.empty(array_LK.shape, dtype=np.uint8)
+        np.logical_or(array_LK, array_RK, out=array.view(bool))
+    return array_LK, array_RK, array
+
+
+def _saveLabels(array, affine, header, path):
+    with profileStage("write"):
+        nibabel.save(nibabel.Nifti1Image(array, affine=affine, header=header, dtype=np.uint8), path)
+
+
+def predictionPaths(inputPath, outputDir):
+    """left kidney, right kidney, post-processed and not post-processed prediction paths written by applyPKDIA"""
+    _, inputFile = os.path.split(inputPath)
+    inputFileName, ext = inputFile.split(os.extsep, 1)
+
+    predLKPath = os.path.join(outputDir, inputFileName + "-prediction-LK." + ext)
+    preRKPath = os.path.join(outputDir, inputFileName + "-prediction-RK." + ext)
+    predPath = os.path.join(outputDir, inputFileName + "-prediction." + ext)
+    predNoppPath = os.path.join(outputDir, inputFileName + "-prediction-nopp." + ext)
+    return predLKPath, preRKPath, predPath, predNoppPath
+
+
+def applyPKDIA(
+    inputPath,
+    outputDir,
+    modality,
+    weightsPath,
+    verbose=False,
+    batchSize="auto",
+    net=None,
+    saveArtifacts=False,
+    progressCallback=None,
+    cancelEvent=None,
+    localizerStride=None,
+    precision="fp32",
+    cache=None,
+):
+    """
+    :param cache: ResultCache consulted before inference, the predictions being keyed by weightsPath and precision which
+        must then be the ones of net if given
+    """
     if verbose:
         logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    img_size = 256
-    n_classes = 1
-    net = swinv2Unet.SwinV2TwoDecoder(
-        model_name="swinv2_cr_tiny_ns_224",
-        pretrained=True,
-        img_size=(img_size, img_size),
-        in_chans=1,
-        n_classes_1dec=n_classes,
-        n_classes_2dec=n_classes,
-    )
+    img_size = IMG_SIZE
     vgg = False
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    test_dataset = tiny_dataset_genkyst_prod(inputPath, outputDir, img_size, modality, vgg, saveArtifacts=saveArtifacts)
 
-    if verbose:
-        logging.info(f"using device {device}")
+    def predict():
+        return predictPKDIA(
+            test_dataset,
+            _loadNet(net, weightsPath, verbose, precision),
+            batchSize,
+            verbose,
+            progressCallback,
+            cancelEvent,
+            localizerStride=localizerStride,
+        )
+
+    array_LK, array_RK = _predictWithCache(
+        test_dataset, cache, weightsPath, precision, localizerStride, progressCallback, predict
+    )
+    return savePKDIAPredictions(test_dataset, array_LK, array_RK, inputPath, outputDir)
+
+
+def savePKDIAPredictions(test_dataset, array_LK, array_RK, inputPath, outputDir):
+    """
+    Post-processes the predictPKDIA masks and writes the four applyPKDIA predictions, returning their paths.
+    """
+    affine, header = test_dataset.exam.volume.affine, test_dataset.exam.volume.header
+    predLKPath, preRKPath, predPath, predNoppPath = predictionPaths(inputPath, outputDir)
+
+    # no post-processing, saved first so that its buffer can hold the post-processed union
+    with profileStage("post-process"):
+        array = np.logical_or(array_LK, array_RK).view(np.uint8)
+    _saveLabels(array, affine, header, predNoppPath)
+
+    array_LK, array_RK, array = postprocessPKDIA(array_LK, array_RK, out=array)
+    _saveLabels(array_LK, affine, header, predLKPath)
+    _saveLabels(array_RK, affine, header, preRKPath)
+    _saveLabels(array, affine, header, predPath)
+    return predLKPath, preRKPath, predPath, predNoppPath
 
-    net.to(device=device)
-    net.load_state_dict(torch.load(weightsPath, map_location=device, weights_only=True))
 
+def applyPKDIAArray(
+    array,
+    ijkToRas,
+    modality,
+    weightsPath=None,
+    verbose=False,
+    batchSize="auto",
+    net=None,
+    progressCallback=None,
+    cancelEvent=None,
+    localizerStride=None,
+    precision="fp32",
+    cache=None,
+    previewStride=None,
+    previewCallback=None,
+):
+    """
+    In-memory counterpart of applyPKDIA, nothing is read from nor written to disk but the cache.
+
+    :param array: voxel array indexed as (i, j, k), e.g. the transpose of slicer.util.arrayFromVolume
+    :param ijkToRas: 4x4 IJK to RAS matrix of the array
+    :param weightsPath: PKDIA weights, only used if net is None
+    :param progressCallback: see predictPKDIA
+    :param cancelEvent: see predictPKDIA
+    :param localizerStride: see predictPKDIA
+    :param precision: fp32, bf16, fp16 or int8 network, only used if net is None
+    :param cache: see applyPKDIA
+    :param previewStride: see predictPKDIA
+    :param previewCallback: see predictPKDIA, called with post-processed label arrays indexed like the input array
+    :return: post-processed left and right kidney label arrays, indexed like the input array
+    """
     if verbose:
-        logging.info("model loaded !")
+        logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-    test_dataset = tiny_dataset_genkyst_prod(inputPath, outputDir, img_size, modality, vgg)
+    image = nibabel.Nifti1Image(array, affine=np.array(ijkToRas, dtype=np.float64))
+    test_dataset = tiny_dataset_genkyst_prod(None, None, IMG_SIZE, modality, image=image)
+    _, affine, _ = get_array_affine_header(test_dataset)
 
-    test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
+    # Predictions are in the canonical exam space, bring them back to the input voxel grid
+    ornt = ornt_transform(io_orientation(affine), io_orientation(image.affine))
 
-    array_LK, affine, header = get_array_affine_header(test_dataset)
-    array_RK = array_LK.copy()
-    array = array_LK.copy()
+    def labels(*masks):
+        return tuple(apply_orientation(getLargestConnectedArea(mask), ornt) for mask in masks)
 
-    with torch.no_grad():
-        for idx, data in enumerate(test_loader):
-            image = data
-            image = image.to(device=device, dtype=torch.float32)
-
-            mask_LK = prob2mask(torch.sigmoid(net(image)[0]))
-            mask_RK = prob2mask(torch.sigmoid(net(image)[1]))
-
-            # == LK
-            mask_LK = rotate(mask_LK, -90, preserve_range=True)
-            mask_LK = resize(
-                mask_LK,
-                output_shape=(test_dataset.exam.volume.shape[0], test_dataset.exam.volume.shape[2]),
-                preserve_range=True,
-            )
-            mask_LK[np.where(mask_LK > 0.95)] = 1
-            mask_LK[np.where(mask_LK != 1)] = 0
-            array_LK[0 : test_dataset.exam.volume.shape[0], idx, 0 : test_dataset.exam.volume.shape[2]] = mask_LK[
-                ::-1, ::
-            ]
-
-            # == RK
-            mask_RK = rotate(mask_RK, -90, preserve_range=True)
-            mask_RK = resize(
-                mask_RK,
-                output_shape=(test_dataset.exam.volume.shape[0], test_dataset.exam.volume.shape[2]),
-                preserve_range=True,
-            )
-            mask_RK[np.where(mask_RK > 0.95)] = 1
-            mask_RK[np.where(mask_RK != 1)] = 0
-            array_RK[0 : test_dataset.exam.volume.shape[0], idx, 0 : test_dataset.exam.volume.shape[2]] = mask_RK[
-                ::-1, ::
-            ]
-
-        array_nopp = array_LK + array_RK
-        array_nopp[np.where(array_nopp > 0.0)] = 1
-        prediction_nopp = nibabel.Nifti1Image(
-            array_nopp.astype(np.uint16), affine=affine, header=header
-        )  # no post-processing
-
-        array_LK = getLargestConnectedArea(array_LK)
-        array_RK = getLargestConnectedArea(array_RK)
-        array = array_LK + array_RK
-        array[np.where(array > 0.0)] = 1
-
-        prediction_LK = nibabel.Nifti1Image(array_LK.astype(np.uint16), affine=affine, header=header)
-        prediction_RK = nibabel.Nifti1Image(array_RK.astype(np.uint16), affine=affine, header=header)
-
-        prediction = nibabel.Nifti1Image(array.astype(np.uint16), affine=affine, header=header)
-
-        _, inputFile = os.path.split(inputPath)
-        inputFileName, ext = inputFile.split(os.extsep, 1)
-
-        predLKPath = os.path.join(outputDir, inputFileName + "-prediction-LK." + ext)
-        preRKPath = os.path.join(outputDir, inputFileName + "-prediction-RK." + ext)
-        predPath = os.path.join(outputDir, inputFileName + "-prediction." + ext)
-        predNoppPath = os.path.join(outputDir, inputFileName + "-prediction-nopp." + ext)
-        nibabel.save(prediction_LK, predLKPath)
-        nibabel.save(prediction_RK, preRKPath)
-        nibabel.save(prediction, predPath)
-        nibabel.save(prediction_nopp, predNoppPath)
-        return predLKPath, preRKPath, predPath, predNoppPath
+    def preview(*masks):
+        previewCallback(*labels(*masks))
+
+    def predict():
+        return predictPKDIA(
+            test_dataset,
+            _loadNet(net, weightsPath, verbose, precision),
+            batchSize,
+            verbose,
+            progressCallback,
+            cancelEvent,
+            localizerStride=localizerStride,
+            previewStride=previewStride,
+            previewCallback=preview if previewCallback is not None else None,
+        )
+
+    masks = _predictWithCache(test_dataset, cache, weightsPath, precision, localizerStride, progressCallback, predict)
+    return labels(*masks)
@@ -0,0 +1,134 @@
+"""
+Headless PKDIA segmentation of a cohort of NIfTI exams, e.g. from the SlicerPKDIALib directory :
+
+    python -m pkdia /data/exams --modality T2 --output /data/predictions
+"""
+
+import argparse
+import logging
+import os
+import sys
+from collections import Counter
+
+import torch
+
+from .cohort import (
+    defaultWeightsPath,
+    listExams,
+    segmentCohort,
+    segmentCohortInParallel,
+)
+from .nets.registry import PRECISIONS
+from .profiling import Profiler, activated
+from .utils.modality import ModalityEnum
+
+MEMORY_UNITS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def memorySize(text):
+    """bytes of a size such as 4G, 512M or 1073741824"""
+    unit = MEMORY_UNITS.get(text[-1:].upper())
+    try:
+        return int(float(text[:-1] if unit is not None else text) * (unit or 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory size {text!r}, e.g. 4G or 512M")
+
+
+def parseArguments(args=None):
+    parser = argparse.ArgumentParser(prog="python -m pkdia", description="Segments polycystic kidneys of NIfTI exams.")
+    parser.add_argument("inputs", nargs="+", help="NIfTI exams, directories of exams or glob patterns")
+    parser.add_argument("--modality", required=True, choices=[modality.name for modality in ModalityEnum])
+    parser.add_argument("--output", required=True, help="directory of the predictions")
+    parser.add_argument("--weights", help="PKDIA weights, defaults to the ones downloaded by the Slicer module")
+    parser.add_argument("--precision", default="fp32", choices=list(PRECISIONS), help="network precision")
+    parser.add_argument("--batch-size", default="auto", help="slices per forward pass, or 'auto'")
+    parser.add_argument("--summary", help="summary CSV with the per-exam timings, defaults to <output>/summary.csv")
+    parser.add_argument("--overwrite", action="store_true", help="segment exams whose predictions already exist")
+    parser.add_argument(
+        "--prefetch", type=int, default=1, help="exams queued between the read, infer and write stages, 0 to disable"
+    )
+    parser.add_argument(
+        "--localizer-stride",
+        type=int,
+        help="segment one coronal slice every N slices first, then only the slices around the kidneys",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=memorySize,
+        help="resident memory of each worker, e.g. 4G : exams are streamed by coronal slabs and --prefetch is ignored",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each with its own model")
+    parser.add_argument(
+        "--threads", type=int, help="torch threads per worker, defaults to the cores split between workers"
+    )
+    parser.add_argument("--profile", help="JSON file of the wall time, CPU time and peak memory of each stage")
+    parser.add_argument("--torch-trace", help="Chrome trace of the forward passes recorded by torch.profiler")
+    args = parser.parse_args(args)
+    if (args.profile is not None or args.torch_trace is not None) and args.workers > 1:
+        parser.error("--profile and --torch-trace need a single worker")
+
+    args.modality = ModalityEnum[args.modality]
+    args.weights = args.weights if args.weights is not None else str(defaultWeightsPath(args.modality))
+    args.summary = args.summary if args.summary is not None else os.path.join(args.output, "summary.csv")
+    args.batch_size = args.batch_size if args.batch_size == "auto" else int(args.batch_size)
+    return args
+
+
+def main(args=None):
+    args = parseArguments(args)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    try:
+        exams = listExams(args.inputs)
+    except ValueError as e:
+        logging.error(e)
+        return 1
+    logging.info(f"{len(exams)} exams to segment")
+    if args.workers > 1:
+        rows = segmentCohortInParallel(
+            exams,
+            args.output,
+            args.modality,
+            args.weights,
+            args.workers,
+            args.threads,
+            args.batch_size,
+            args.overwrite,
+            args.summary,
+            args.localizer_stride,
+            args.precision,
+            args.memory_budget,
+        )
+    else:
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        profiler = None
+        if args.profile is not None or args.torch_trace is not None:
+            profiler = Profiler(args.torch_trace)
+        with activated(profiler):
+            rows = segmentCohort(
+                exams,
+                args.output,
+                args.modality,
+                args.weights,
+                args.batch_size,
+                args.overwrite,
+                args.summary,
+                prefetch=args.prefetch,
+                localizerStride=args.localizer_stride,
+                precision=args.precision,
+                memoryBudget=args.memory_budget,
+            )
+        if profiler is not None:
+            profiler.close()
+            logging.info(profiler.summary())
+        if args.profile is not None:
+            profiler.writeJson(args.profile)
+
+    statuses = Counter(row["status"] for row in rows)
+    logging.info(", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+    return 1 if statuses["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
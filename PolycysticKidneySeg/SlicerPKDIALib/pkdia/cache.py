@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .nets.registry import precisionName, weightsChecksum
+
+PIPELINE_VERSION = 1  # to be increased whenever a change of the pipeline changes its predictions
+
+
+def resultKey(test_dataset, modality, weightsPath, precision="fp32", localizerStride=None):
+    """
+    Hex digest of everything the predictions of a dataset exam depend on : its voxels and geometry once loaded by
+    the exam, the modality, the weights checksum, the options changing predictions and the pipeline version.
+    """
+    volume = test_dataset.exam.volume
+    data = np.ascontiguousarray(volume.dataobj)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((data.shape, data.dtype.str)).encode())
+    digest.update(data)
+    digest.update(np.asarray(volume.affine, dtype=np.float64).tobytes())
+    options = (str(modality), weightsChecksum(weightsPath), precisionName(precision), localizerStride)
+    digest.update(repr((options, PIPELINE_VERSION)).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of the left and right kidney masks predicted by predictPKDIA, keyed by resultKey.
+    Masks are stored bit-packed and compressed ; once the cache exceeds maxBytes, the least recently used predictions
+    are evicted first.
+    """
+
+    def __init__(self, cacheDir, maxBytes=2**30):
+        self.cacheDir = Path(cacheDir)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return self.cacheDir / f"{key}.npz"
+
+    def _log(self, event):
+        logging.info(f"PKDIA result cache {event} ({self.hits} hits, {self.misses} misses)")
+
+    def get(self, key):
+        """cached (array_LK, array_RK) masks of key, None if they are not in the cache"""
+        path = self._path(key)
+        try:
+            with np.load(path) as arrays:
+                shape = tuple(arrays["shape"])
+                masks = tuple(
+                    np.unpackbits(arrays[name], count=math.prod(shape)).reshape(shape) for name in ("LK", "RK")
+                )
+            os.utime(path)  # most recently used
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            self._log("miss")
+            return None
+
+        self.hits += 1
+        self._log("hit")
+        return masks
+
+    def put(self, key, array_LK, array_RK):
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        temporaryPath = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temporaryPath, "wb") as f:
+            np.savez_compressed(
+                f,
+                shape=np.array(array_LK.shape),
+                LK=np.packbits(array_LK.astype(bool, copy=False), axis=None),
+                RK=np.packbits(array_RK.astype(bool, copy=False), axis=None),
+            )
+        os.replace(temporaryPath, path)  # readers never see a partial file
+        self.evict()
+
+    def evict(self):
+        """removes the least recently used predictions until the cache fits in maxBytes"""
+        entries = []
+        for path in self.cacheDir.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entrySize for _, entrySize, _ in entries)
+        for _, entrySize, path in sorted(entries):
+            if size <= self.maxBytes:
+                break
+            path.unlink(missing_ok=True)
+            size -= entrySize
+            logging.info(f"Evicted {path.name} from the PKDIA result cache")
+
+    def clear(self):
+        for path in self.cacheDir.glob("*.npz"):
+            path.unlink(missing_ok=True)
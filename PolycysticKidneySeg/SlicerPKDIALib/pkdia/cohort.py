@@ -0,0 +1,326 @@
+import csv
+import glob
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import torch
+
+from .datasets.dataset_genkyst import tiny_dataset_genkyst_prod
+from .nets.registry import IMG_SIZE, loadPKDIANet
+from .pipeline import Pipeline
+from .PKDIA import applyPKDIA, predictionPaths, predictPKDIA, savePKDIAPredictions
+from .streaming import applyPKDIAStreaming
+from .utils.modality import ModalityEnum
+
+WEIGHTS_DIR = Path(__file__).resolve().parents[2] / "weights"
+WEIGHTS_FILE_NAMES = {ModalityEnum.T2: "PKDIAv1-weights.pth", ModalityEnum.CT: "PKDIAv2-weights.pth"}
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+SUMMARY_FIELDS = ("exam", "status", "seconds", "error")
+MAX_ATTEMPTS = 2  # exams are retried once if their worker process died
+
+_workerNet = None  # network of a cohort worker process
+
+
+def defaultWeightsPath(modality):
+    """weights downloaded by the Slicer module for modality"""
+    return WEIGHTS_DIR / WEIGHTS_FILE_NAMES[ModalityEnum(modality)]
+
+
+def _isExam(path):
+    name = os.path.basename(path)
+    isOutput = "-prediction" in name or name.split(os.extsep, 1)[0].endswith("-prod")
+    return os.path.isfile(path) and name.endswith(NIFTI_EXTENSIONS) and not isOutput
+
+
+def listExams(inputs):
+    """
+    Sorted NIfTI exams of the given files, directories and glob patterns, PKDIA outputs excluded.
+    Raises ValueError if exams of different directories have the same file name, their predictions being named after it.
+    """
+    exams = set()
+    for pattern in [inputs] if isinstance(inputs, (str, os.PathLike)) else inputs:
+        pattern = str(pattern)
+        if os.path.isdir(pattern):
+            pattern = os.path.join(glob.escape(pattern), "*")
+        exams.update(os.path.normpath(path) for path in glob.glob(pattern) if _isExam(path))
+
+    exams = sorted(exams)
+    names = Counter(os.path.basename(path) for path in exams)
+    duplicates = [path for path in exams if names[os.path.basename(path)] > 1]
+    if duplicates:
+        raise ValueError(f"exams with the same file name would have the same predictions : {', '.join(duplicates)}")
+    return exams
+
+
+def isSegmented(inputPath, outputDir):
+    return all(os.path.exists(path) for path in predictionPaths(inputPath, outputDir))
+
+
+def segmentExam(inputPath, outputDir, modality, net, batchSize="auto", localizerStride=None, memoryBudget=None):
+    """
+    Segments one exam of a cohort, a failure being reported in the returned summary row instead of raised.
+    With memoryBudget, the exam is streamed by applyPKDIAStreaming within memoryBudget bytes of resident memory.
+    """
+    start = time.perf_counter()
+    status, error = "segmented", ""
+    try:
+        if memoryBudget is not None:
+            applyPKDIAStreaming(
+                inputPath,
+                outputDir,
+                modality,
+                None,
+                memoryBudget,
+                batchSize=batchSize,
+                net=net,
+                localizerStride=localizerStride,
+            )
+        else:
+            applyPKDIA(
+                inputPath, outputDir, modality, None, batchSize=batchSize, net=net, localizerStride=localizerStride
+            )
+    except Exception as e:  # noqa
+        logging.exception(f"Failed to segment {inputPath}")
+        status, error = "failed", repr(e)
+    return {"exam": inputPath, "status": status, "seconds": f"{time.perf_counter() - start:.2f}", "error": error}
+
+
+class SummaryWriter:
+    """Appends the summary rows of a cohort to a CSV file as soon as they are known"""
+
+    def __init__(self, summaryPath):
+        self.summaryPath = summaryPath
+        if summaryPath is not None and not os.path.exists(summaryPath):
+            with open(summaryPath, "w", newline="") as f:
+                csv.DictWriter(f, SUMMARY_FIELDS).writeheader()
+
+    def write(self, row):
+        logging.info(f"{row['status']} {row['exam']} in {row['seconds']}s")
+        if self.summaryPath is not None:
+            with open(self.summaryPath, "a", newline="") as f:
+                csv.DictWriter(f, SUMMARY_FIELDS).writerow(row)
+
+
+def _skippedRow(inputPath):
+    return {"exam": inputPath, "status": "skipped", "seconds": "0.00", "error": ""}
+
+
+def reportThroughput(rows, seconds):
+    """logs and returns the number of exams segmented per hour"""
+    segmented = sum(row["status"] == "segmented" for row in rows)
+    examsPerHour = segmented * 3600 / seconds if seconds > 0 else 0.0
+    logging.info(f"{segmented} exams segmented in {seconds:.1f}s : {examsPerHour:.1f} exams/hour")
+    return examsPerHour
+
+
+def _timed(function):
+    """stage of an exam pipeline, accumulating its duration in the exam state"""
+
+    def stage(exam):
+        start = time.perf_counter()
+        exam = function(exam)
+        exam["seconds"] += time.perf_counter() - start
+        return exam
+
+    return stage
+
+
+def examPipeline(outputDir, modality, net, batchSize="auto", queueSize=1, localizerStride=None):
+    """
+    Pipeline reading and preprocessing the next exams while the current one is inferred and the previous ones are
+    post-processed and written. Items are the input paths, the output being the exam state with its prediction paths.
+    """
+
+    @_timed
+    def read(exam):
+        exam["dataset"] = tiny_dataset_genkyst_prod(exam["inputPath"], outputDir, IMG_SIZE, modality)
+        exam["images"] = exam["dataset"].images()
+        return exam
+
+    @_timed
+    def infer(exam):
+        exam["arrays"] = predictPKDIA(
+            exam["dataset"], net, batchSize, images=exam.pop("images"), localizerStride=localizerStride
+        )
+        return exam
+
+    @_timed
+    def write(exam):
+        exam["predictionPaths"] = savePKDIAPredictions(
+            exam.pop("dataset"), *exam.pop("arrays"), exam["inputPath"], outputDir
+        )
+        return exam
+
+    stages = [
+        ("read", lambda inputPath: read({"inputPath": inputPath, "seconds": 0.0})),
+        ("infer", infer),
+        ("write", write),
+    ]
+    return Pipeline(stages, queueSize)
+
+
+def segmentCohort(
+    exams,
+    outputDir,
+    modality,
+    weightsPath=None,
+    batchSize="auto",
+    overwrite=False,
+    summaryPath=None,
+    net=None,
+    prefetch=1,
+    localizerStride=None,
+    precision="fp32",
+    memoryBudget=None,
+):
+    """
+    Segments exams with a single network, loaded once.
+    With prefetch > 0, exams go through an examPipeline holding up to prefetch exams between its stages, so that disk
+    and preprocessing time is hidden behind inference. Otherwise exams are segmented one after the other, streamed
+    within memoryBudget bytes of resident memory if given, prefetch being then ignored.
+    Exams whose predictions are already in outputDir are skipped unless overwrite is True.
+    Returns the summary rows, also appended to the summaryPath CSV if given.
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    summary = SummaryWriter(summaryPath)
+    start = time.perf_counter()
+    rows = []
+
+    pending = []
+    for inputPath in exams:
+        if not overwrite and isSegmented(inputPath, outputDir):
+            rows.append(_skippedRow(inputPath))
+            summary.write(rows[-1])
+        else:
+            pending.append(inputPath)
+
+    if pending and net is None:
+        net = loadPKDIANet(weightsPath if weightsPath is not None else defaultWeightsPath(modality), dtype=precision)
+
+    if prefetch > 0 and memoryBudget is None:
+        pipeline = examPipeline(outputDir, modality, net, batchSize, prefetch, localizerStride)
+        for inputPath, exam, error in pipeline.run(pending):
+            if error is not None:
+                logging.error(f"Failed to segment {inputPath}", exc_info=error)
+            rows.append(
+                {
+                    "exam": inputPath,
+                    "status": "segmented" if error is None else "failed",
+                    "seconds": f"{exam['seconds']:.2f}" if error is None else "",
+                    "error": "" if error is None else repr(error),
+                }
+            )
+            summary.write(rows[-1])
+        for metrics in pipeline.metrics:
+            logging.info(metrics)
+        if pending:
+            logging.info(f"Pipeline bottleneck : {pipeline.bottleneck().name} stage")
+    else:
+        for inputPath in pending:
+            rows.append(segmentExam(inputPath, outputDir, modality, net, batchSize, localizerStride, memoryBudget))
+            summary.write(rows[-1])
+
+    reportThroughput(rows, time.perf_counter() - start)
+    return rows
+
+
+def _initWorker(weightsPath, threads, precision):
+    global _workerNet
+    torch.set_num_threads(threads)
+    _workerNet = loadPKDIANet(weightsPath, dtype=precision)
+
+
+def _segmentInWorker(inputPath, outputDir, modality, batchSize, localizerStride, memoryBudget):
+    return segmentExam(inputPath, outputDir, modality, _workerNet, batchSize, localizerStride, memoryBudget)
+
+
+def segmentCohortInParallel(
+    exams,
+    outputDir,
+    modality,
+    weightsPath=None,
+    workers=2,
+    threadsPerWorker=None,
+    batchSize="auto",
+    overwrite=False,
+    summaryPath=None,
+    localizerStride=None,
+    precision="fp32",
+    memoryBudget=None,
+):
+    """
+    segmentCohort sharded across worker processes, each with its own network and torch.set_num_threads budget
+    (the CPU cores split between the workers by default), and memoryBudget if given. Exams left unfinished by a dead
+    worker process are segmented again one at a time, and reported as failed if their own worker dies MAX_ATTEMPTS
+    times.
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    weightsPath = str(weightsPath if weightsPath is not None else defaultWeightsPath(modality))
+    threadsPerWorker = threadsPerWorker if threadsPerWorker is not None else max(1, (os.cpu_count() or 1) // workers)
+    summary = SummaryWriter(summaryPath)
+    start = time.perf_counter()
+    rows = []
+
+    pending = []
+    for inputPath in exams:
+        if not overwrite and isSegmented(inputPath, outputDir):
+            rows.append(_skippedRow(inputPath))
+            summary.write(rows[-1])
+        else:
+            pending.append(inputPath)
+
+    def newPool(maxWorkers):
+        return ProcessPoolExecutor(
+            max_workers=maxWorkers,
+            mp_context=multiprocessing.get_context("spawn"),  # torch threads don't survive a fork
+            initializer=_initWorker,
+            initargs=(weightsPath, threadsPerWorker, precision),
+        )
+
+    def submit(pool, inputPath):
+        return pool.submit(_segmentInWorker, inputPath, outputDir, modality, batchSize, localizerStride, memoryBudget)
+
+    # a dead worker breaks the futures of every unfinished exam of the pool, whichever exam it was segmenting
+    suspects = []
+    if pending:
+        with newPool(min(workers, len(pending))) as pool:
+            futures = {submit(pool, inputPath): inputPath for inputPath in pending}
+            for future in as_completed(futures):
+                try:
+                    row = future.result()
+                except BrokenProcessPool:
+                    suspects.append(futures[future])
+                    continue
+                summary.write(row)
+                rows.append(row)
+
+    # suspects are segmented one at a time, so that only the exam whose worker died loses an attempt
+    attempts = dict.fromkeys(suspects, 0)
+    while suspects:
+        with newPool(1) as pool:
+            while suspects:
+                inputPath = suspects[0]
+                try:
+                    row = submit(pool, inputPath).result()
+                except BrokenProcessPool as e:
+                    attempts[inputPath] += 1
+                    if attempts[inputPath] < MAX_ATTEMPTS:
+                        break  # retried in a new pool
+                    suspects.pop(0)
+                    row = {"exam": inputPath, "status": "failed", "seconds": "", "error": repr(e)}
+                    summary.write(row)
+                    rows.append(row)
+                    break  # the next suspects need a new pool
+                suspects.pop(0)
+                summary.write(row)
+                rows.append(row)
+
+    reportThroughput(rows, time.perf_counter() - start)
+    return rows
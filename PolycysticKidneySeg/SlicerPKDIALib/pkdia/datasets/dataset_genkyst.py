@@ -2,21 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import torch
 from torch.utils.data.dataset import Dataset
 
 from ..exams.exam_genkyst_prod import exam_genkyst_prod
-from ..manage.manage_genkyst import extract_genkyst_slice_prod
-from ..utils.utils import normalization_imgs
+from ..manage.manage_genkyst import (
+    extract_genkyst_slice_prod,
+    extract_genkyst_volume_prod,
+)
+from ..profiling import profileStage
+from ..utils.utils import normalization_imgs, normalization_slices
 
 
 class tiny_dataset_genkyst_prod(Dataset):
-    def __init__(self, inputPath, outputDir, size, modality, vgg: bool = False):
+    def __init__(self, inputPath, outputDir, size, modality, vgg: bool = False, image=None, saveArtifacts=False):
         self.inputPath = inputPath
         self.outputDir = outputDir
         self.size = size
         self.vgg = vgg
         self.modality = modality
-        self.exam = exam_genkyst_prod(self.inputPath, self.outputDir, self.modality)
+        self.exam = exam_genkyst_prod(self.inputPath, self.outputDir, self.modality, image, saveArtifacts)
         self.exam.normalize()
 
     def __len__(self):
@@ -32,4 +37,15 @@ class tiny_dataset_genkyst_prod(Dataset):
         if self.vgg:
             img_[:, :, 1], img_[:, :, 2] = img, img
         img_ = normalization_imgs(img_)
-        return img_.swapaxes(2, 0)
+        return img_.swapaxes(2, 0), idx
+
+    def images(self, start=0, stop=None):
+        """
+        Slices [start, stop) preprocessed at once, as the (N, C, size, size) float32 tensor the batched items would form.
+        """
+        with profileStage("preprocess"):
+            imgs = normalization_slices(extract_genkyst_volume_prod(self.exam, self.size, start, stop))
+            imgs = torch.from_numpy(imgs.swapaxes(1, 2)).unsqueeze(1)
+            if self.vgg:
+                imgs = imgs.expand(-1, 3, -1, -1)
+            return imgs.contiguous()
@@ -6,34 +6,55 @@ import os
 import nibabel
 import numpy as np
 
+from ..profiling import profileStage
 from ..utils.modality import ModalityEnum
 from ..utils.utils import normalization_imgs
 
 
 class exam_genkyst_prod:  # PKDIAv2
-    def __init__(self, inputPath, outputPath, modality):
+    def __init__(self, inputPath, outputPath, modality, image=None, saveArtifacts=False):
+        """
+        image: already loaded nibabel image, used instead of reading inputPath
+        saveArtifacts: writes the canonical volume to outputPath as <input>-prod, for debugging purposes
+        """
 
         self.inputPath = inputPath
         self.outputPath = outputPath
         self.modality = modality
+        self.image = image
+        self.saveArtifacts = saveArtifacts
+        self.data = None
         self.volume = None
         self.exam_upload()
 
     def exam_upload(self):
-        self.volume = nibabel.as_closest_canonical(nibabel.load(self.inputPath))
-
-        _, inputFile = os.path.split(self.inputPath)
-        inputFileName, ext = inputFile.split(os.extsep, 1)
-        outputFile = inputFileName + "-prod." + ext
-
-        if self.modality == ModalityEnum.CT:
-            data = self.volume.get_fdata()
-            data = np.transpose(data, [0, 2, 1])
-            affine = self.volume.affine
-            affine[:, [1, 2]] = affine[:, [2, 1]]
-            self.volume = nibabel.Nifti1Image(data, affine=affine)
-
-        nibabel.save(self.volume, os.path.join(self.outputPath, outputFile))
+        with profileStage("NIfTI read"):
+            image = self.image if self.image is not None else nibabel.load(self.inputPath)
+        with profileStage("canonicalization"):
+            canonical = nibabel.as_closest_canonical(image)
+
+        # float32 voxels owned by the exam, which normalizes them in place
+        with profileStage("NIfTI read"):
+            if nibabel.is_proxy(canonical.dataobj):
+                self.data = canonical.get_fdata(caching="unchanged", dtype=np.float32)
+            else:
+                self.data = np.array(canonical.dataobj, dtype=np.float32)
+
+        with profileStage("canonicalization"):
+            if self.modality == ModalityEnum.CT:
+                self.data = np.transpose(self.data, [0, 2, 1])
+                affine = canonical.affine.copy()
+                affine[:, [1, 2]] = affine[:, [2, 1]]
+                self.volume = nibabel.Nifti1Image(self.data, affine=affine)
+            else:
+                self.volume = nibabel.Nifti1Image(self.data, affine=canonical.affine, header=canonical.header)
+
+        if self.saveArtifacts and self.inputPath is not None and self.outputPath is not None:
+            _, inputFile = os.path.split(self.inputPath)
+            inputFileName, ext = inputFile.split(os.extsep, 1)
+            outputFile = inputFileName + "-prod." + ext
+            nibabel.save(self.volume, os.path.join(self.outputPath, outputFile))
 
     def normalize(self):
-        self.volume.get_fdata()[:, :, :] = normalization_imgs(self.volume.get_fdata())[:, :, :]
+        with profileStage("normalization"):
+            self.data[:, :, :] = normalization_imgs(self.data)[:, :, :]
@@ -0,0 +1,79 @@
+"""
+TorchScript export of the PKDIA networks, loaded by loadPKDIANet instead of building them with timm, e.g. from the
+SlicerPKDIALib directory, for the weights downloaded by the Slicer module :
+
+    python -m pkdia.export --precisions fp32 int8
+"""
+
+import argparse
+import logging
+import os
+import sys
+import warnings
+
+import torch
+
+from .cohort import defaultWeightsPath
+from .nets.registry import IMG_SIZE, PRECISIONS, exportedPath, loadPKDIANet
+from .utils.modality import ModalityEnum
+
+EXPORT_TOLERANCE = 1e-3  # of the export check, relative to the largest logit
+
+
+def _forward(net, images):
+    dtype = images.dtype
+    with torch.no_grad(), torch.autocast(images.device.type, dtype=dtype, enabled=dtype != torch.float32):
+        return [logits.float() for logits in net(images)]
+
+
+def exportPKDIANet(weightsPath, device="cpu", dtype=torch.float32):
+    """
+    Traces the eager network of weightsPath and saves it to its exportedPath, replacing any previous export.
+    The export is checked against the eager network on another number of slices than the traced one.
+    Returns the path of the export.
+    """
+    device = torch.device(device)
+    net = loadPKDIANet(weightsPath, device, dtype, exported=False)
+    inputDtype = next(net.parameters()).dtype
+    images = torch.randn(2, 1, IMG_SIZE, IMG_SIZE, device=device, dtype=inputDtype)
+
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        with torch.autocast(device.type, dtype=inputDtype, enabled=inputDtype != torch.float32):
+            tracedNet = torch.jit.trace(net, images, check_trace=False)
+
+    images = torch.randn(3, 1, IMG_SIZE, IMG_SIZE, device=device, dtype=inputDtype)
+    for logits, tracedLogits in zip(_forward(net, images), _forward(tracedNet, images)):
+        error = (logits - tracedLogits).abs().max().item()
+        if error > EXPORT_TOLERANCE * max(logits.abs().max().item(), 1.0):
+            raise RuntimeError(f"Exported PKDIA network differs from the eager one by {error}")
+
+    path = exportedPath(weightsPath, device, dtype)
+    temporaryPath = path.with_name(path.name + ".tmp")
+    tracedNet.save(str(temporaryPath))
+    os.replace(temporaryPath, path)  # never leaves a partial export behind
+    logging.info(f"Exported {weightsPath} to {path}")
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pkdia.export", description="Exports PKDIA networks to TorchScript next to their weights."
+    )
+    parser.add_argument(
+        "--weights", nargs="+", help="PKDIA weights, defaults to the ones downloaded by the Slicer module"
+    )
+    parser.add_argument("--precisions", nargs="+", default=["fp32"], choices=list(PRECISIONS))
+    parser.add_argument("--device", default="cpu", help="device the exports will run on")
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    weightsPaths = args.weights if args.weights is not None else [defaultWeightsPath(m) for m in ModalityEnum]
+    for weightsPath in weightsPaths:
+        for precision in args.precisions:
+            exportPKDIANet(weightsPath, args.device, precision)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import hashlib
+import logging
+
+import nibabel
+import numpy as np
+from nibabel.orientations import apply_orientation, io_orientation, ornt_transform
+
+from .cache import resultKey
+from .datasets.dataset_genkyst import tiny_dataset_genkyst_prod
+from .nets.registry import IMG_SIZE
+from .PKDIA import predictPKDIA
+from .utils.modality import ModalityEnum
+from .utils.utils import getLargestConnectedArea
+
+
+def examSlices(mask, affine, modality):
+    """
+    Coronal slices of the exam of a voxel array, as loaded by exam_genkyst_prod, holding at least one voxel of mask.
+    mask is indexed (i, j, k) like the array, e.g. its edited voxels or a region of interest.
+    """
+    canonical = apply_orientation(mask, io_orientation(affine))  # as nibabel.as_closest_canonical
+    if modality == ModalityEnum.CT:
+        canonical = canonical.transpose(0, 2, 1)
+    return np.flatnonzero(canonical.any(axis=(0, 2)))
+
+
+def coronalAxis(affine, modality):
+    """axis of a voxel array holding the coronal slices of its exam, and whether they are in reverse order there"""
+    ornt = io_orientation(affine)
+    axis = int(np.flatnonzero(ornt[:, 0] == (2 if modality == ModalityEnum.CT else 1))[0])
+    return axis, bool(ornt[axis, 1] < 0)
+
+
+def sliceDigests(array, axis):
+    """digest of the voxels of each slice of array along axis"""
+    return [
+        hashlib.blake2b(np.ascontiguousarray(np.take(array, index, axis=axis)).tobytes(), digest_size=16).digest()
+        for index in range(array.shape[axis])
+    ]
+
+
+class IncrementalSegmentation:
+    """
+    applyPKDIAArray segmentation of a voxel array that is updated instead of recomputed : the masks of the last run and
+    a digest of each of its coronal slices are kept, so that only the coronal slices whose voxels changed, or that are
+    in a requested region, are inferred again. The largest connected areas are only searched again for the kidneys
+    whose masks changed.
+    Slices are preprocessed independently of each other, the global intensity normalization of the exam being undone
+    by the per-slice rescaling : the other slices keep their predictions.
+    """
+
+    def __init__(self, modality, net=None, weightsPath=None, batchSize="auto", precision="fp32", cache=None):
+        """
+        :param net: network of weightsPath, may be set later but before the first segment call needing inference
+        :param cache: ResultCache consulted when the whole volume is segmented, see applyPKDIA
+        """
+        self.modality = modality
+        self.net = net
+        self.weightsPath = weightsPath
+        self.batchSize = batchSize
+        self.precision = precision
+        self.cache = cache
+
+        self._geometry = None  # shape, dtype and affine of the last segmented array
+        self._digests = None  # sliceDigests of the last segmented array along its coronal axis
+        self._masks = None  # left and right kidney masks in the exam space, before post-processing
+        self._labels = None
+
+    def _isUpdateOf(self, array, affine):
+        if self._geometry is None:
+            return False
+        shape, dtype, previousAffine = self._geometry
+        return shape == array.shape and dtype == array.dtype and np.array_equal(previousAffine, affine)
+
+    def _segmentVolume(self, test_dataset, progressCallback, cancelEvent, previewStride, previewCallback):
+        nSlices = len(test_dataset)
+        key = None
+        if self.cache is not None and self.weightsPath is not None:
+            key = resultKey(test_dataset, self.modality, self.weightsPath, self.precision)
+            masks = self.cache.get(key)
+            if masks is not None:
+                if progressCallback is not None:
+                    progressCallback(nSlices, nSlices)
+                return list(masks)
+
+        masks = predictPKDIA(
+            test_dataset,
+            self.net,
+            self.batchSize,
+            progressCallback=progressCallback,
+            cancelEvent=cancelEvent,
+            previewStride=previewStride,
+            previewCallback=previewCallback,
+        )
+        if key is not None:
+            self.cache.put(key, *masks)
+        return list(masks)
+
+    def _segmentSlices(self, test_dataset, slices, progressCallback, cancelEvent):
+        """updates the masks of slices in place, returning whether each kidney mask changed"""
+        previousMasks = [mask[:, slices, :].copy() for mask in self._masks]
+        try:
+            predictPKDIA(
+                test_dataset,
+                self.net,
+                self.batchSize,
+                progressCallback=progressCallback,
+                cancelEvent=cancelEvent,
+                slices=slices,
+                out=self._masks,
+            )
+        except BaseException:
+            # a cancelled update leaves the session as it was
+            for mask, previousMask in zip(self._masks, previousMasks):
+                mask[:, slices, :] = previousMask
+            raise
+        return [
+            not np.array_equal(mask[:, slices, :], previousMask)
+            for mask, previousMask in zip(self._masks, previousMasks)
+        ]
+
+    def segment(
+        self,
+        array,
+        ijkToRas,
+        region=None,
+        progressCallback=None,
+        cancelEvent=None,
+        previewStride=None,
+        previewCallback=None,
+    ):
+        """
+        Segments array, the whole volume on the first call or when its geometry changed, else only the slices whose
+        voxels changed since the last call and those holding a voxel of region.
+
+        :param array: voxel array indexed as (i, j, k), see applyPKDIAArray
+        :param region: index expression of array (e.g. a tuple of slices) to segment again, even if unchanged
+        :param progressCallback: see predictPKDIA
+        :param cancelEvent: see predictPKDIA, the session keeping its last results when cancelled
+        :param previewStride: see predictPKDIA, only used when the whole volume is segmented
+        :param previewCallback: see applyPKDIAArray
+        :return: post-processed left and right kidney label arrays indexed like array, and whether each one changed
+        """
+        affine = np.array(ijkToRas, dtype=np.float64)
+        image = nibabel.Nifti1Image(array, affine=affine)
+        test_dataset = tiny_dataset_genkyst_prod(None, None, IMG_SIZE, self.modality, image=image)
+        nSlices = len(test_dataset)
+
+        axis, isReversed = coronalAxis(affine, self.modality)
+        digests = sliceDigests(array, axis)
+
+        # Labels are in the canonical exam space, bring them back to the input voxel grid
+        ornt = ornt_transform(io_orientation(test_dataset.exam.volume.affine), io_orientation(affine))
+
+        def preview(*masks):
+            previewCallback(*(apply_orientation(getLargestConnectedArea(mask), ornt) for mask in masks))
+
+        if not self._isUpdateOf(array, affine):
+            self._masks = self._segmentVolume(
+                test_dataset,
+                progressCallback,
+                cancelEvent,
+                previewStride,
+                preview if previewCallback is not None else None,
+            )
+            changed = [True, True]
+            self._labels = [None, None]
+        else:
+            slices = np.flatnonzero([digest != previous for digest, previous in zip(digests, self._digests)])
+            if isReversed:
+                slices = nSlices - 1 - slices[::-1]
+            if region is not None:
+                regionVoxels = np.zeros(array.shape, dtype=bool)
+                regionVoxels[region] = True
+                slices = np.union1d(slices, examSlices(regionVoxels, affine, self.modality))
+            logging.info(f"segmenting again {len(slices)} of {nSlices} coronal slices")
+            changed = [False, False]
+            if len(slices):
+                changed = self._segmentSlices(test_dataset, slices, progressCallback, cancelEvent)
+
+        for kidney, isChanged in enumerate(changed):
+            if isChanged:
+                self._labels[kidney] = getLargestConnectedArea(self._masks[kidney])
+        self._geometry = (array.shape, array.dtype, affine)
+        self._digests = digests
+
+        array_LK, array_RK = (apply_orientation(labels, ornt) for labels in self._labels)
+        return array_LK, array_RK, tuple(changed)
@@ -6,13 +6,42 @@ from skimage import img_as_ubyte
 from skimage.exposure import rescale_intensity
 from skimage.transform import resize, rotate
 
+from ..utils.utils import resize_stack
+
+SLICES_PER_CHUNK = 16  # bounds the float64 working copies of the full resolution slices
+
 
 def extract_genkyst_slice_prod(exam, idx, size):
     img = rotate(
-        resize(np.squeeze(exam.volume.get_fdata()[:, idx, :])[::-1, :], output_shape=(size, size), preserve_range=True),
+        resize(
+            np.squeeze(exam.data[:, idx, :]).astype(np.float64)[::-1, :], output_shape=(size, size), preserve_range=True
+        ),
         90,
         preserve_range=True,
     )
     min_greyscale, max_greyscale = np.percentile(img, (1, 99))
     img = rescale_intensity(img, in_range=(min_greyscale, max_greyscale), out_range=(0, 1))
     return img_as_ubyte(img)
+
+
+def extract_genkyst_volume_prod(exam, size, start=0, stop=None):
+    """
+    extract_genkyst_slice_prod for the coronal slices [start, stop) at once, as a (N, size, size) uint8 array.
+    """
+    stop = exam.data.shape[1] if stop is None else stop
+    imgs = np.empty((max(stop - start, 0), size, size), dtype=np.uint8)
+    for chunkStart in range(start, stop, SLICES_PER_CHUNK):
+        chunkStop = min(chunkStart + SLICES_PER_CHUNK, stop)
+        chunk = exam.data[:, chunkStart:chunkStop, :].transpose(1, 0, 2)[:, ::-1, :]
+        chunk = np.rot90(resize_stack(chunk, output_shape=(size, size)), 1, axes=(1, 2))
+
+        min_greyscale, max_greyscale = np.percentile(chunk, (1, 99), axis=(1, 2), keepdims=True)
+        chunk = np.clip(chunk, min_greyscale, max_greyscale)
+        contrasted = max_greyscale != min_greyscale
+        chunk = np.where(
+            contrasted,
+            (chunk - min_greyscale) / np.where(contrasted, max_greyscale - min_greyscale, 1),
+            np.clip(chunk, 0, 1),
+        )
+        imgs[chunkStart - start : chunkStop - start] = np.clip(np.rint(chunk * 255), 0, 255)
+    return imgs
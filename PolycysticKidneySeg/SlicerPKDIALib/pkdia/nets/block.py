@@ -30,6 +30,25 @@ class SimpleConv(nn.Module):
         return self.simple_conv(x)
 
 
+class SliceBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d normalizing each sample of the batch with its own statistics"""
+
+    def forward(self, x):
+        if x.shape[0] == 1:
+            return functional.batch_norm(x, None, None, self.weight, self.bias, True, 0.0, self.eps)
+        return functional.instance_norm(x, None, None, self.weight, self.bias, True, 0.0, self.eps)
+
+
+def slice_batch_norm(module):
+    """turns the BatchNorm2d layers of module into SliceBatchNorm2d layers, keeping their parameters"""
+    for child in module.children():
+        if type(child) is nn.BatchNorm2d:
+            child.__class__ = SliceBatchNorm2d
+        else:
+            slice_batch_norm(child)
+    return module
+
+
 class DoubleConv(nn.Module):
     """{Conv2d, BN, ReLU}x2"""
 
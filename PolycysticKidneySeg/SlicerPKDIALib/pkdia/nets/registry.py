@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+
+import torch
+
+from ..profiling import profileStage
+from . import block, swinv2Unet
+
+IMG_SIZE = 256
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16, "int8": torch.qint8}
+QUANTIZED_STAGES = ("skip0", "skip1", "skip2", "center")  # swinv2_cr transformer stages, dominated by nn.Linear
+
+
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def precisionDtype(precision):
+    """torch dtype of a precision name (fp32, bf16, fp16, int8), dtypes being returned unchanged"""
+    if isinstance(precision, torch.dtype):
+        return precision
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}")
+    return PRECISIONS[precision]
+
+
+def precisionName(dtype):
+    """name of a precision or of its torch dtype, see PRECISIONS"""
+    dtype = precisionDtype(dtype)
+    return next(name for name, candidate in PRECISIONS.items() if candidate == dtype)
+
+
+@lru_cache(maxsize=8)
+def _fileChecksum(path, size, mtime):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(2**24):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def weightsChecksum(weightsPath):
+    """SHA-256 of the weights file, only recomputed when the file changes"""
+    stat = os.stat(weightsPath)
+    return _fileChecksum(str(Path(weightsPath).resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+def exportedPath(weightsPath, device="cpu", dtype=torch.float32):
+    """
+    Path of the TorchScript export of the network of weightsPath, next to the weights and keyed by their checksum so
+    that an export of other weights is never used.
+    """
+    weightsPath = Path(weightsPath)
+    name = weightsPath.name.split(".", 1)[0]
+    checksum = weightsChecksum(weightsPath)[:16]
+    return weightsPath.with_name(f"{name}-{checksum}-{precisionName(dtype)}-{torch.device(device).type}.ts")
+
+
+def loadExportedNet(weightsPath, device=None, dtype=torch.float32):
+    """TorchScript export of the network of weightsPath, None if it was not exported or can't be loaded"""
+    device = torch.device(device) if device is not None else default_device()
+    path = exportedPath(weightsPath, device, dtype)
+    if not path.exists():
+        return None
+    try:
+        net = torch.jit.load(str(path), map_location=device)
+    except Exception:  # noqa
+        logging.warning(f"Failed to load the exported PKDIA network {path}, using the eager one", exc_info=True)
+        return None
+    logging.info(f"Loaded the exported PKDIA network {path}")
+    return net.eval()
+
+
+def _buildSwinV2TwoDecoder():
+    n_classes = 1
+    return swinv2Unet.SwinV2TwoDecoder(
+        model_name="swinv2_cr_tiny_ns_224",
+        pretrained=False,  # every weight is overwritten by the PKDIA ones
+        img_size=(IMG_SIZE, IMG_SIZE),
+        in_chans=1,
+        n_classes_1dec=n_classes,
+        n_classes_2dec=n_classes,
+    )
+
+
+def _loadOnMetaDevice(state_dict, device):
+    """
+    Builds the network without allocating nor initializing its weights, which are directly assigned from state_dict.
+    Returns None if some tensors could not be materialized (e.g. timm buffers not computable outside __init__).
+    """
+    with torch.device("meta"):
+        net = _buildSwinV2TwoDecoder()
+    net.load_state_dict(state_dict, assign=True)
+
+    # Non-persistent timm buffers (attention masks, relative coordinates) are not part of the checkpoint
+    for module in net.modules():
+        for name, buffer in list(module.named_buffers(recurse=False)):
+            if buffer.is_meta:
+                module.register_buffer(name, torch.empty_like(buffer, device=device), persistent=False)
+        for initBuffers in ("_init_buffers", "_make_pair_wise_relative_positions", "_make_attention_mask"):
+            if hasattr(module, initBuffers):
+                getattr(module, initBuffers)()
+                break
+
+    if any(tensor.is_meta for tensor in chain(net.parameters(), net.buffers())):
+        return None
+    return net
+
+
+def quantizeEncoder(net):
+    """
+    Dynamic int8 quantization of the Linear layers of the transformer stages of net, in place : their weights are
+    quantized once and their activations on the fly, the rest of the network staying in float32. CPU only.
+    """
+    for name in QUANTIZED_STAGES:
+        stage = torch.ao.quantization.quantize_dynamic(
+            getattr(net, name), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        setattr(net, name, stage)
+    return net
+
+
+def loadPKDIANet(weightsPath, device=None, dtype=torch.float32, exported=True, fused=False):
+    """
+    Builds the PKDIA SwinV2TwoDecoder network and loads its weights, ready for inference on device.
+    dtype may also be a precision name, see PRECISIONS, torch.qint8 giving a quantizeEncoder network.
+    If exported, the TorchScript export of the weights (see pkdia.export) is loaded instead when there is one.
+    If fused, the two decoders are run as one, see FusedSwinV2TwoDecoder.
+    """
+    device = torch.device(device) if device is not None else default_device()
+    dtype = precisionDtype(dtype)
+    if dtype == torch.qint8 and device.type != "cpu":
+        raise ValueError(f"int8 PKDIA networks only run on CPU, not on {device}")
+    if exported and not fused:
+        with profileStage("weight load"):
+            net = loadExportedNet(weightsPath, device, dtype)
+        if net is not None:
+            return net
+    with profileStage("weight load"):
+        state_dict = torch.load(weightsPath, map_location=device, weights_only=True)
+
+    with profileStage("model build"):
+        net = _loadOnMetaDevice(state_dict, device)
+        if net is None:
+            net = _buildSwinV2TwoDecoder()
+            net.load_state_dict(state_dict)
+        net.to(device=device)
+
+        # PKDIA networks are applied in training mode, one slice at a time : keep normalizing each slice with its own
+        # statistics so that slices can be batched
+        block.slice_batch_norm(net)
+        net.eval()
+        if fused:
+            net = swinv2Unet.FusedSwinV2TwoDecoder(net)
+        if dtype == torch.qint8:
+            return quantizeEncoder(net)
+        return net.to(dtype=dtype)
+
+
+class ModelRegistry:
+    """
+    Keeps the most recently used PKDIA networks in memory, keyed by (modality, weights path, device, dtype), so that
+    consecutive segmentations don't rebuild and reload them.
+    """
+
+    def __init__(self, maxSize=2):
+        self.maxSize = maxSize
+        self._models = OrderedDict()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    @staticmethod
+    def key(modality, weightsPath, device=None, dtype=torch.float32):
+        device = torch.device(device) if device is not None else default_device()
+        return str(modality), str(Path(weightsPath).resolve()), str(device), str(precisionDtype(dtype))
+
+    def get(self, modality, weightsPath, device=None, dtype=torch.float32):
+        device = torch.device(device) if device is not None else default_device()
+        key = self.key(modality, weightsPath, device, dtype)
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+
+        net = loadPKDIANet(weightsPath, device, dtype)
+        self._models[key] = net
+        while len(self._models) > self.maxSize:
+            evictedKey, _ = self._models.popitem(last=False)
+            logging.info(f"Released PKDIA model {evictedKey}")
+        return net
+
+    def release(self):
+        self._models.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -143,3 +143,133 @@ class SwinV2TwoDecoder(nn.Module):
         logits2 = self.outc2(out2)
 
         return logits1, logits2
+
+
+def _stackedConv(convs, sharedInput):
+    """
+    Conv2d computing the outputs of convs side by side, either on one shared input or on their inputs side by side
+    (grouped convolution)
+    """
+    weight = torch.cat([conv.weight for conv in convs])
+    groups = 1 if sharedInput else len(convs)
+    with torch.device("meta"):
+        stacked = nn.Conv2d(
+            weight.shape[1] * groups,
+            weight.shape[0],
+            convs[0].kernel_size,
+            convs[0].stride,
+            convs[0].padding,
+            groups=groups,
+        )
+    stacked.weight = nn.Parameter(weight, requires_grad=False)
+    stacked.bias = nn.Parameter(torch.cat([conv.bias for conv in convs]), requires_grad=False)
+    return stacked
+
+
+def _stackedConvTranspose(ups, sharedInput):
+    """ConvTranspose2d counterpart of _stackedConv, its weights being indexed (in, out, kernel)"""
+    weight = torch.cat([up.weight for up in ups], dim=1 if sharedInput else 0)
+    groups = 1 if sharedInput else len(ups)
+    with torch.device("meta"):
+        stacked = nn.ConvTranspose2d(
+            weight.shape[0], weight.shape[1] * groups, ups[0].kernel_size, ups[0].stride, groups=groups
+        )
+    stacked.weight = nn.Parameter(weight, requires_grad=False)
+    stacked.bias = nn.Parameter(torch.cat([up.bias for up in ups]), requires_grad=False)
+    return stacked
+
+
+def _stackedNorm(norms):
+    """BatchNorm2d (or SliceBatchNorm2d) of the channels of norms side by side, as norms are channel-wise"""
+    with torch.device("meta"):
+        stacked = type(norms[0])(norms[0].num_features * len(norms), norms[0].eps, norms[0].momentum)
+    stacked.weight = nn.Parameter(torch.cat([norm.weight for norm in norms]), requires_grad=False)
+    stacked.bias = nn.Parameter(torch.cat([norm.bias for norm in norms]), requires_grad=False)
+    stacked.running_mean = torch.cat([norm.running_mean for norm in norms])
+    stacked.running_var = torch.cat([norm.running_var for norm in norms])
+    stacked.num_batches_tracked = norms[0].num_batches_tracked.clone()
+    return stacked.train(norms[0].training)
+
+
+def _stackedConvBlock(convBlocks):
+    """DoubleConv / QuadripleConv of grouped convolutions, from the ones of each decoder"""
+    layers = []
+    for modules in zip(*[next(convBlock.children()) for convBlock in convBlocks]):
+        if isinstance(modules[0], nn.Conv2d):
+            layers.append(_stackedConv(modules, sharedInput=False))
+        elif isinstance(modules[0], nn.BatchNorm2d):
+            layers.append(_stackedNorm(modules))
+        else:
+            layers.append(modules[0])
+    return nn.Sequential(*layers)
+
+
+class FusedUp(nn.Module):
+    """
+    Up-sampling block (DoubleUp, QuadripleUp, Doublewith2Up) of several decoders computed as one, the channels of each
+    decoder being side by side. x1 is the shared encoder features if sharedInput, else the stacked decoders outputs ; x2
+    is the shared encoder skip connection if sharedSkip, else the stacked skip connections of the decoders.
+    """
+
+    def __init__(self, blocks, sharedInput=False, sharedSkip=True):
+        super().__init__()
+        self.nDecoders = len(blocks)
+        self.sharedSkip = sharedSkip
+        self.up = _stackedConvTranspose([block_.up for block_ in blocks], sharedInput)
+        self.upSkip = None
+        if isinstance(blocks[0], Doublewith2Up):  # also up-samples its skip connection, with the same layer
+            self.upSkip = _stackedConvTranspose([block_.up for block_ in blocks], sharedInput=True)
+        self.conv = _stackedConvBlock([block_.conv for block_ in blocks])
+
+    def forward(self, x1, x2):
+        x1 = self.up(x1).chunk(self.nDecoders, dim=1)
+        if self.upSkip is not None:
+            x2 = self.upSkip(x2).chunk(self.nDecoders, dim=1)
+        elif self.sharedSkip:
+            x2 = [x2] * self.nDecoders
+        else:
+            x2 = x2.chunk(self.nDecoders, dim=1)
+        return self.conv(torch.cat([x for pair in zip(x1, x2) for x in pair], dim=1))
+
+
+class FusedSwinV2TwoDecoder(nn.Module):
+    """
+    Inference-only SwinV2TwoDecoder whose two decoders, structurally identical, run as one decoder of grouped
+    convolutions twice as wide. The encoder modules are shared with the source network, the decoder weights copied.
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        self.n_channels = net.n_channels
+        self.n_classes = net.n_classes
+        self.n_classes_1dec = net.outc1.conv.out_channels
+
+        self.patch_embed = net.patch_embed
+        self.skip0 = net.skip0
+        self.skip1 = net.skip1
+        self.skip2 = net.skip2
+        self.center = net.center
+
+        self.deblock1 = FusedUp([net.deblock1_1, net.deblock2_1], sharedInput=True)
+        self.deblock2 = FusedUp([net.deblock1_2, net.deblock2_2])
+        self.deblock3 = FusedUp([net.deblock1_3, net.deblock2_3])
+        self.deblock4 = FusedUp([net.deblock1_4, net.deblock2_4])
+        self.conv = _stackedConv([net.conv1, net.conv2], sharedInput=True)
+        self.deblock5 = FusedUp([net.deblock1_5, net.deblock2_5], sharedSkip=False)
+        self.outc = _stackedConv([net.outc1.conv, net.outc2.conv], sharedInput=False)
+        self.train(net.training)
+
+    def forward(self, x):
+        x1 = self.patch_embed(x)
+        x2 = self.skip0(x1)
+        x3 = self.skip1(x2)
+        x4 = self.skip2(x3)
+        x5 = self.center(x4)
+
+        out = self.deblock1(x5, x4)
+        out = self.deblock2(out, x3)
+        out = self.deblock3(out, x2)
+        out = self.deblock4(out, x1)
+        out = self.deblock5(out, self.conv(x))
+        logits = self.outc(out)
+        return logits[:, : self.n_classes_1dec], logits[:, self.n_classes_1dec :]
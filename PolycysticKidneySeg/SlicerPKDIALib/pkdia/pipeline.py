@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class StageMetrics:
+    """Time spent by a pipeline stage working and waiting, and depth of its input queue when it takes an item"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busySeconds = 0.0
+        self.inputWaitSeconds = 0.0  # starved : waiting for the previous stage
+        self.outputWaitSeconds = 0.0  # blocked : waiting for the next stage to take its output
+        self.queueDepths = []
+
+    @property
+    def meanQueueDepth(self):
+        return sum(self.queueDepths) / len(self.queueDepths) if self.queueDepths else 0.0
+
+    def asDict(self):
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "busySeconds": round(self.busySeconds, 3),
+            "inputWaitSeconds": round(self.inputWaitSeconds, 3),
+            "outputWaitSeconds": round(self.outputWaitSeconds, 3),
+            "meanQueueDepth": round(self.meanQueueDepth, 2),
+            "maxQueueDepth": max(self.queueDepths, default=0),
+        }
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.items} items, busy {self.busySeconds:.1f}s, waiting for input "
+            f"{self.inputWaitSeconds:.1f}s, waiting for output {self.outputWaitSeconds:.1f}s, queue depth "
+            f"{self.meanQueueDepth:.2f} on average, {max(self.queueDepths, default=0)} at most"
+        )
+
+
+class Pipeline:
+    """
+    Runs each stage function in its own thread, stages being connected by bounded queues so that consecutive items are
+    processed concurrently (e.g. reading the next exam while the current one is inferred). An exception raised by a stage
+    is passed along, the following stages skipping the failed item.
+    """
+
+    def __init__(self, stages, queueSize=1):
+        """
+        :param stages: (name, function) pairs, function taking the output of the previous stage
+        :param queueSize: items waiting between two stages, bounding the number of items held in memory
+        """
+        self.stages = stages
+        self.queueSize = queueSize
+        self.metrics = [StageMetrics(name) for name, _ in stages]
+
+    def bottleneck(self):
+        return max(self.metrics, key=lambda metrics: metrics.busySeconds, default=None)
+
+    def _runStage(self, function, metrics, inputs, outputs):
+        while True:
+            start = time.perf_counter()
+            depth = inputs.qsize()
+            entry = inputs.get()
+            metrics.inputWaitSeconds += time.perf_counter() - start
+            if entry is _END:
+                outputs.put(_END)
+                return
+
+            metrics.queueDepths.append(depth)
+            item, value, error = entry
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    value = function(value)
+                except Exception as e:  # noqa
+                    value, error = None, e
+                metrics.busySeconds += time.perf_counter() - start
+                metrics.items += 1
+
+            start = time.perf_counter()
+            outputs.put((item, value, error))
+            metrics.outputWaitSeconds += time.perf_counter() - start
+
+    def run(self, items):
+        """
+        Generator of (item, output of the last stage, exception or None), in the order of items.
+        """
+        queues = [queue.Queue(maxsize=self.queueSize) for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(target=self._runStage, args=(function, metrics, inputs, outputs), daemon=True)
+            for (_, function), metrics, inputs, outputs in zip(self.stages, self.metrics, queues[:-1], queues[1:])
+        ]
+        for thread in threads:
+            thread.start()
+
+        def feed():
+            for item in items:
+                queues[0].put((item, item, None))
+            queues[0].put(_END)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        while (entry := queues[-1].get()) is not _END:
+            yield entry
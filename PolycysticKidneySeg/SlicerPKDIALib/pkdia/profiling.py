@@ -0,0 +1,232 @@
+import ctypes
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    _mallocTrim = ctypes.CDLL("libc.so.6").malloc_trim
+except (OSError, AttributeError):  # not glibc
+    _mallocTrim = None
+
+# Stages of a segmentation, in pipeline order
+STAGES = (
+    "model build",
+    "weight load",
+    "NIfTI read",
+    "canonicalization",
+    "normalization",
+    "preprocess",
+    "forward",
+    "post-process",
+    "connected components",
+    "write",
+    "Slicer import",
+)
+
+_activeProfilers = []  # the last one records the stages of every thread
+_activeProfilersLock = threading.Lock()
+
+
+def _statusBytes(field):
+    """memory field of /proc/self/status in bytes, None if there is no such file (not Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _residentMemory():
+    """resident memory of the process in bytes, None if it can't be measured"""
+    return _statusBytes("VmRSS")
+
+
+def _peakMemory():
+    """high-water mark of the process resident memory in bytes, 0 if it can't be measured"""
+    peak = _statusBytes("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _releaseFreeMemory():
+    """
+    gives the free heap memory back to the system where supported (glibc), so that the resident memory at the start of
+    a stage is the memory in use, not pages freed by the previous stages that the stage might or might not reuse
+    """
+    if _mallocTrim is not None:
+        _mallocTrim(0)
+
+
+def _resetPeakMemory():
+    """resets the high-water mark where supported (Linux), else peaks are the ones of the whole process lifetime"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class StageProfile:
+    """Wall time, process CPU time and peak resident memory of a profiled stage, summed over its calls"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wallSeconds = 0.0
+        self.cpuSeconds = 0.0  # of every thread of the process, e.g. torch intra-op threads
+        self.peakBytes = 0
+        self.peakIncreaseBytes = 0  # above the resident memory at the start of the stage, 0 if it can't be measured
+
+    def asDict(self):
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "wallSeconds": round(self.wallSeconds, 4),
+            "cpuSeconds": round(self.cpuSeconds, 4),
+            "peakBytes": self.peakBytes,
+            "peakIncreaseBytes": self.peakIncreaseBytes,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.calls} calls, wall {self.wallSeconds:.2f}s, CPU {self.cpuSeconds:.2f}s, "
+            f"peak memory {self.peakBytes / 2**20:.0f} MB (+{self.peakIncreaseBytes / 2**20:.0f} MB)"
+        )
+
+
+class Profiler:
+    """
+    Profiles the stages marked with profileStage while activated, in every thread (e.g. the cohort pipeline ones).
+    The peak memory of a stage is the one of the whole process while the stage runs, nested stages included, and its
+    peak increase how far it rose above the resident memory at the start of the stage, i.e. the memory of the stage
+    itself. Voxels of lazily loaded images are read by the first stage accessing them.
+    """
+
+    def __init__(self, torchTracePath=None):
+        """
+        :param torchTracePath: if set, torch.profiler records the process from the first forward stage until close,
+            forward calls being labelled, and its Chrome trace is written to torchTracePath
+        """
+        self.torchTracePath = torchTracePath
+        self.torchTable = None  # operators taking the most CPU time, once closed
+        self.stages = {}
+        self._openStages = []  # [profile, peak bytes, starting resident bytes] of the running stages
+        self._lock = threading.Lock()
+        self._torchProfile = None
+
+    @contextmanager
+    def activate(self):
+        """profileStage calls of every thread record their stage in this profiler within this context"""
+        with _activeProfilersLock:
+            _activeProfilers.append(self)
+        try:
+            yield self
+        finally:
+            with _activeProfilersLock:
+                _activeProfilers.remove(self)
+
+    def _updatePeaks(self):
+        peak = _peakMemory()
+        for openStage in self._openStages:
+            openStage[1] = max(openStage[1], peak)
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            profile = self.stages.setdefault(name, StageProfile(name))
+            self._updatePeaks()
+            _releaseFreeMemory()
+            _resetPeakMemory()
+            openStage = [profile, 0, _residentMemory()]
+            self._openStages.append(openStage)
+
+        start, cpuStart = time.perf_counter(), time.process_time()
+        try:
+            if name == "forward" and self.torchTracePath is not None:
+                with self._recordTorch():
+                    yield
+            else:
+                yield
+        finally:
+            wallSeconds, cpuSeconds = time.perf_counter() - start, time.process_time() - cpuStart
+            with self._lock:
+                self._updatePeaks()
+                self._openStages.remove(openStage)
+                profile.calls += 1
+                profile.wallSeconds += wallSeconds
+                profile.cpuSeconds += cpuSeconds
+                profile.peakBytes = max(profile.peakBytes, openStage[1])
+                if openStage[2] is not None:
+                    profile.peakIncreaseBytes = max(profile.peakIncreaseBytes, openStage[1] - openStage[2])
+
+    @contextmanager
+    def _recordTorch(self):
+        import torch
+
+        if self._torchProfile is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torchProfile = torch.profiler.profile(activities=activities)
+            self._torchProfile.start()
+        with torch.profiler.record_function("PKDIA forward"):
+            yield
+
+    def close(self):
+        """stops torch.profiler, writing its trace"""
+        if self._torchProfile is None:
+            return
+        self._torchProfile.stop()
+        self._torchProfile.export_chrome_trace(str(self.torchTracePath))
+        self.torchTable = self._torchProfile.key_averages().table(sort_by="self_cpu_time_total", row_limit=10)
+        self._torchProfile = None
+        logging.info(f"torch profiler trace written to {self.torchTracePath}")
+
+    def _orderedStages(self):
+        order = {name: index for index, name in enumerate(STAGES)}
+        return sorted(self.stages.values(), key=lambda profile: order.get(profile.name, len(STAGES)))
+
+    def asDict(self):
+        return {"stages": [profile.asDict() for profile in self._orderedStages()]}
+
+    def writeJson(self, path):
+        with open(path, "w") as f:
+            json.dump(self.asDict(), f, indent=2)
+
+    def summary(self):
+        lines = ["PKDIA profile:"] + [f"  {profile}" for profile in self._orderedStages()]
+        if self.torchTable is not None:
+            lines.append(self.torchTable)
+        return "\n".join(lines)
+
+
+def activated(profiler):
+    """profiler.activate(), or a context doing nothing if profiler is None"""
+    return profiler.activate() if profiler is not None else nullcontext()
+
+
+@contextmanager
+def profileStage(name):
+    """Records name in the last activated profiler, if any"""
+    with _activeProfilersLock:
+        profiler = _activeProfilers[-1] if _activeProfilers else None
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
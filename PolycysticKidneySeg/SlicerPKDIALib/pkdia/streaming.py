@@ -0,0 +1,336 @@
+"""
+Memory-bounded applyPKDIA for exams too large to be segmented in memory, e.g. whole-body CTs: the exam is read from its
+NIfTI proxy one coronal slab at a time and the predictions are written in place through memory maps of their files.
+"""
+
+import gzip
+import logging
+import mmap
+import os
+import shutil
+from types import SimpleNamespace
+
+import nibabel
+import numpy as np
+from nibabel.orientations import apply_orientation, inv_ornt_aff, io_orientation
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
+
+from .datasets.dataset_genkyst import tiny_dataset_genkyst_prod
+from .nets.registry import IMG_SIZE
+from .PKDIA import _loadNet, _localizedSlices, predictionPaths, predictPKDIA
+from .profiling import profileStage
+from .utils.modality import ModalityEnum
+from .utils.utils import SLICE_MEMORY, auto_batch_size, get_resident_memory
+
+# estimated peak memory per voxel of a slab : voxels read, float32 and float64 working copies, masks and labels
+SLAB_VOXEL_MEMORY = 32
+
+
+def planSlabs(memoryBudget, sliceVoxels, nSlices, device):
+    """
+    (slices per slab, batch size) keeping the resident memory of the process within memoryBudget bytes, half of the
+    memory left by the already resident one (e.g. the network) going to the forward passes on CPU and the rest to slabs.
+    """
+    resident = get_resident_memory() or 0
+    available = memoryBudget - resident
+    forwardMemory = SLICE_MEMORY if device.type == "cpu" else 0
+    if available < forwardMemory + sliceVoxels * SLAB_VOXEL_MEMORY:
+        logging.warning(
+            f"memory budget of {memoryBudget / 2**20:.0f} MB too small with {resident / 2**20:.0f} MB already "
+            "resident, segmenting one slice at a time"
+        )
+        return 1, 1
+
+    if device.type == "cpu":
+        batchSize = auto_batch_size(device, memory=available)
+        forwardMemory = batchSize * SLICE_MEMORY
+    else:
+        batchSize = auto_batch_size(device)
+    slabSlices = int(np.clip((available - forwardMemory) // (sliceVoxels * SLAB_VOXEL_MEMORY), 1, nSlices))
+    return slabSlices, batchSize
+
+
+class StreamedExam:
+    """
+    exam_genkyst_prod whose volume is read from the NIfTI proxy of its file one coronal slab at a time, never at once.
+    """
+
+    def __init__(self, inputPath, modality):
+        self.modality = modality
+        with profileStage("NIfTI read"):
+            self.image = nibabel.load(inputPath, mmap=True, keep_file_open=True)
+        if len(self.image.shape) != 3:
+            raise ValueError(f"{inputPath} is not a 3D volume")
+
+        # as_closest_canonical, then the CT transposition, without reading the voxels
+        with profileStage("canonicalization"):
+            self.ornt = io_orientation(self.image.affine)
+            shape = [0] * 3
+            for axis, (canonicalAxis, _) in enumerate(self.ornt):
+                shape[int(canonicalAxis)] = self.image.shape[axis]
+            affine = self.image.affine.dot(inv_ornt_aff(self.ornt, self.image.shape))
+            if modality == ModalityEnum.CT:
+                shape[1], shape[2] = shape[2], shape[1]
+                affine[:, [1, 2]] = affine[:, [2, 1]]
+                header = None
+            else:
+                header = self.image.header.copy()
+                dimInfo = header.get_dim_info()
+                header.set_dim_info(*[None if axis is None else int(self.ornt[axis, 0]) for axis in dimInfo])
+        self.shape, self.affine, self.header = tuple(shape), affine, header
+        self.mean, self.std = 0.0, 1.0
+
+    def __len__(self):
+        return self.shape[1]
+
+    def slab(self, slices, normalized=True):
+        """float32 (shape[0], slices, shape[2]) voxels of the coronal slices of the exam volume"""
+        canonicalAxis = 2 if self.modality == ModalityEnum.CT else 1
+        axis = int(np.flatnonzero(self.ornt[:, 0] == canonicalAxis)[0])
+        size = self.image.shape[axis]
+        index = [slice(None)] * 3
+        index[axis] = slices if self.ornt[axis, 1] > 0 else slice(size - slices.stop, size - slices.start)
+        with profileStage("NIfTI read"):
+            data = np.asarray(self.image.dataobj[tuple(index)], dtype=np.float32)
+        with profileStage("canonicalization"):
+            data = apply_orientation(data, self.ornt)
+            if self.modality == ModalityEnum.CT:
+                data = data.transpose(0, 2, 1)
+        if normalized:
+            with profileStage("normalization"):
+                data -= np.float32(self.mean)
+                data /= np.float32(self.std)
+        return data
+
+    def normalize(self, slabs):
+        """normalization_imgs of the whole volume, its mean and standard deviation being accumulated slab by slab"""
+        count, mean, squares = 0, 0.0, 0.0
+        for slices in slabs:
+            data = self.slab(slices, normalized=False)
+            with profileStage("normalization"):
+                slabMean = data.mean(dtype=np.float64)
+                slabSquares = data.var(dtype=np.float64) * data.size
+                delta, total = slabMean - mean, count + data.size
+                mean += delta * data.size / total
+                squares += slabSquares + delta**2 * count * data.size / total
+                count = total
+        std = np.sqrt(squares / count)
+        if np.int32(std) != 0:
+            self.mean, self.std = mean, std
+
+
+class _SlabDataset(tiny_dataset_genkyst_prod):
+    """tiny_dataset_genkyst_prod of already normalized coronal slices"""
+
+    def __init__(self, data, modality):
+        self.inputPath, self.outputDir = None, None
+        self.size, self.vgg, self.modality = IMG_SIZE, False, modality
+        self.exam = SimpleNamespace(data=data, volume=data)  # only the volume shape is used
+
+
+class MappedLabels:
+    """uint8 NIfTI label volume whose voxels are written in place through a memory map of its file"""
+
+    def __init__(self, path, shape, affine, header):
+        # the broadcast zeros are written without being allocated
+        zeros = np.broadcast_to(np.uint8(0), shape)
+        nibabel.save(nibabel.Nifti1Image(zeros, affine=affine, header=header, dtype=np.uint8), path)
+        proxy = nibabel.load(path).dataobj
+        if proxy.dtype != np.uint8 or proxy.slope != 1 or proxy.inter != 0:
+            raise ValueError(f"{path} voxels are scaled")
+
+        self.path = path
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.array = np.ndarray(shape, dtype=np.uint8, buffer=self._map, offset=proxy.offset, order="F")
+
+    def release(self):
+        """writes the voxels to the file and drops their pages from the resident memory where supported (not Windows)"""
+        self._map.flush()
+        if hasattr(mmap, "MADV_DONTNEED"):
+            self._map.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        if self._map.closed:
+            return
+        self._map.flush()
+        self.array = None  # the map can't be closed while exported
+        self._map.close()
+        self._file.close()
+
+
+def _slabLabels(mask, slices, offset):
+    """labels of the connected areas (6-connectivity) of mask[:, slices] numbered from offset + 1, and their sizes"""
+    labels, count = ndimage.label(mask[:, slices], structure=ndimage.generate_binary_structure(3, 1))
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+    labels[labels > 0] += offset
+    return labels, sizes
+
+
+def largestConnectedArea(mask, slabs, release=None):
+    """
+    getLargestConnectedArea of mask computed in place slab by slab along axis 1, slabs being consecutive slices
+    covering it: areas labelled in different slabs are merged when they touch across a slab boundary. Ties are resolved
+    in favor of the area first met in slab order. release() is called after each slab, e.g. to drop its mapped pages.
+    """
+    offsets, sizes, edges, lastPlane = [], [], [], None
+    with profileStage("connected components"):
+        for slices in slabs:
+            offsets.append(sum(map(len, sizes)))
+            labels, slabSizes = _slabLabels(mask, slices, offsets[-1])
+            sizes.append(slabSizes)
+            if lastPlane is not None:
+                firstPlane = labels[:, 0, :]
+                touching = (lastPlane > 0) & (firstPlane > 0)
+                edges.append(np.unique(np.stack([lastPlane[touching], firstPlane[touching]]), axis=1))
+            lastPlane = labels[:, -1, :].copy()
+            if release is not None:
+                release()
+
+        sizes = np.concatenate(sizes)
+        if not len(sizes):
+            return mask
+        edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=np.int64)
+        graph = sparse.coo_matrix((np.ones(edges.shape[1]), (edges[0] - 1, edges[1] - 1)), shape=(len(sizes),) * 2)
+        _, areas = csgraph.connected_components(graph, directed=False)
+        isKept = np.zeros(len(sizes) + 1, dtype=bool)  # by label, 0 being the background
+        isKept[1:] = areas == np.argmax(np.bincount(areas, weights=sizes))
+
+        for slices, offset in zip(slabs, offsets):
+            labels, _ = _slabLabels(mask, slices, offset)
+            mask[:, slices] = isKept[labels]
+            if release is not None:
+                release()
+    return mask
+
+
+def _compress(path, compressedPath):
+    """gzips path to compressedPath the way nibabel does, a chunk at a time"""
+    with profileStage("write"), open(path, "rb") as f, gzip.GzipFile(compressedPath, "wb", 1, mtime=0) as g:
+        shutil.copyfileobj(f, g, 16 * 2**20)
+
+
+def applyPKDIAStreaming(
+    inputPath,
+    outputDir,
+    modality,
+    weightsPath,
+    memoryBudget,
+    verbose=False,
+    batchSize="auto",
+    net=None,
+    progressCallback=None,
+    cancelEvent=None,
+    localizerStride=None,
+    precision="fp32",
+    localizerMargin=2,
+):
+    """
+    applyPKDIA keeping the resident memory within about memoryBudget bytes, the network included, whatever the size of
+    the exam. Coronal slabs sized by planSlabs are read from the input proxy, segmented and written through memory maps
+    of uncompressed NIfTI files, gzipped at the end for .nii.gz inputs. The input is read twice, for the normalization
+    then the segmentation, and .nii.gz slabs are decompressed from the start of the file: .nii inputs are read faster.
+
+    :param localizerStride: see predictPKDIA, the coarse pass going through the whole exam before the other slices
+        around its kidneys are segmented, only the slabs holding them being read again
+    """
+    if verbose:
+        logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    net = _loadNet(net, weightsPath, verbose, precision)
+    exam = StreamedExam(inputPath, modality)
+    sliceVoxels = exam.shape[0] * exam.shape[2]
+    slabSlices, plannedBatchSize = planSlabs(memoryBudget, sliceVoxels, len(exam), next(net.parameters()).device)
+    batchSize = plannedBatchSize if batchSize == "auto" else batchSize
+    slabs = [slice(start, min(start + slabSlices, len(exam))) for start in range(0, len(exam), slabSlices)]
+    if verbose:
+        logging.info(f"streaming {len(slabs)} slabs of {slabSlices} coronal slices, batches of {batchSize} slices")
+
+    outputPaths = predictionPaths(inputPath, outputDir)
+    mappedPaths = [path[: -len(".gz")] if path.endswith(".gz") else path for path in outputPaths]
+    mappedPaths = [path[: -len(".nii")] + ".streaming.nii" for path in mappedPaths]
+    outputs = []
+    try:
+        with profileStage("write"):
+            for path in mappedPaths:
+                outputs.append(MappedLabels(path, exam.shape, exam.affine, exam.header))
+        labels_LK, labels_RK, labels, labels_nopp = outputs
+
+        def release():
+            for output in outputs:
+                output.release()
+
+        segmentedSlices = 0
+
+        def progress(segmented, _):
+            progressCallback(segmentedSlices + segmented, len(exam))
+
+        def segmentSlabs(indices):
+            """segments the exam slices of indices, reading only the slabs holding them"""
+            nonlocal segmentedSlices
+            for slices in slabs:
+                slabIndices = indices[(indices >= slices.start) & (indices < slices.stop)]
+                if not len(slabIndices):
+                    continue
+                data = exam.slab(slices)[:, slabIndices - slices.start, :]
+                masks = np.zeros((2, data.shape[0], len(slabIndices), data.shape[2]), dtype=np.uint8)
+                predictPKDIA(
+                    _SlabDataset(data, modality),
+                    net,
+                    batchSize,
+                    progressCallback=progress if progressCallback is not None else None,
+                    cancelEvent=cancelEvent,
+                    out=tuple(masks),
+                )
+                segmentedSlices += len(slabIndices)
+                with profileStage("post-process"):
+                    labels_LK.array[:, slabIndices] = masks[0]
+                    labels_RK.array[:, slabIndices] = masks[1]
+                    labels_nopp.array[:, slabIndices] = masks[0] | masks[1]
+                release()
+
+        exam.normalize(slabs)
+        if localizerStride is None or localizerStride <= 1:
+            segmentSlabs(np.arange(len(exam)))
+        else:
+            coarseSlices = np.arange(0, len(exam), localizerStride)
+            segmentSlabs(coarseSlices)
+            localizedSlices = _localizedSlices(
+                labels_LK.array, labels_RK.array, coarseSlices, localizerStride, localizerMargin
+            )
+            release()
+            segmentSlabs(localizedSlices)
+
+            skippedSlices = len(exam) - segmentedSlices
+            logging.info(f"localizer skipped {skippedSlices} of {len(exam)} coronal slices")
+            if skippedSlices and progressCallback is not None:
+                progressCallback(len(exam), len(exam))
+
+        largestConnectedArea(labels_LK.array, slabs, release)
+        largestConnectedArea(labels_RK.array, slabs, release)
+        with profileStage("post-process"):
+            for slices in slabs:
+                np.logical_or(
+                    labels_LK.array[:, slices], labels_RK.array[:, slices], out=labels.array[:, slices].view(bool)
+                )
+                release()
+
+        for output in outputs:
+            output.close()
+        for mappedPath, path in zip(mappedPaths, outputPaths):
+            if path.endswith(".gz"):
+                _compress(mappedPath, path)
+                os.remove(mappedPath)
+            else:
+                os.replace(mappedPath, path)
+    finally:
+        for output in outputs:
+            output.close()
+        for path in mappedPaths:
+            if os.path.exists(path):
+                os.remove(path)
+    return outputPaths
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+from functools import lru_cache
+
 import numpy as np
-from skimage.measure import label
+import torch
+from scipy import ndimage
+
+from ..profiling import profileStage
+
+SLICE_MEMORY = 160 * 2**20  # peak memory of a SwinV2TwoDecoder float32 forward pass, per 256x256 slice
 
 
 def normalization_imgs(imgs):
@@ -16,26 +24,172 @@ def normalization_imgs(imgs):
     return imgs
 
 
+def normalization_slices(imgs):
+    """normalization_imgs applied independently to each imgs[i]"""
+    imgs = imgs.astype(np.float32, copy=False)
+    axes = tuple(range(1, imgs.ndim))
+    mean = np.mean(imgs, axis=axes, keepdims=True)
+    std = np.std(imgs, axis=axes, keepdims=True)
+    normalized = std.astype(np.int32) != 0
+    imgs -= np.where(normalized, mean, 0)
+    imgs /= np.where(normalized, std, 1)
+    return imgs
+
+
+def _mirror_indices(indices, n):
+    """indices reflected into [0, n) the way scipy.ndimage 'mirror' mode does (d c b | a b c d | c b a)"""
+    if n == 1:
+        return np.zeros_like(indices)
+    indices = np.abs(indices) % (2 * n - 2)
+    return np.where(indices >= n, 2 * n - 2 - indices, indices)
+
+
+@lru_cache(maxsize=8)
+def _resize_matrix(n, size, truncate=4.0):
+    """
+    (size, n) matrix of skimage.transform.resize along one axis : gaussian anti-aliasing when downsampling, then linear
+    interpolation on the pixel-centered grid, both with 'mirror' boundaries.
+    """
+    rows = np.arange(size)[:, None]
+    coords = (np.arange(size) + 0.5) * (n / size) - 0.5
+    lower = np.floor(coords)
+    matrix = np.zeros((size, n))
+    np.add.at(matrix, (rows, _mirror_indices(lower.astype(np.intp), n)[:, None]), (1 - (coords - lower))[:, None])
+    np.add.at(matrix, (rows, _mirror_indices(lower.astype(np.intp) + 1, n)[:, None]), (coords - lower)[:, None])
+
+    if n > size:
+        sigma = (n / size - 1) / 2
+        radius = int(truncate * sigma + 0.5)
+        offsets = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 / sigma**2 * offsets**2)
+        kernel /= kernel.sum()
+        gaussian = np.zeros((n, n))
+        np.add.at(gaussian, (np.arange(n)[:, None], _mirror_indices(np.arange(n)[:, None] + offsets, n)), kernel)
+        matrix = matrix @ gaussian
+    matrix.flags.writeable = False
+    return matrix
+
+
+def resize_stack(stack, output_shape):
+    """
+    skimage.transform.resize(img, output_shape, preserve_range=True) applied to every img = stack[i] at once : gaussian
+    anti-aliasing of the downsampled axes, bilinear interpolation and clipping to the range of each input slice.
+    """
+    stack = np.asarray(stack, dtype=np.float64)
+    height, width = stack.shape[1:]
+    resized = stack
+    if height != output_shape[0]:
+        resized = _resize_matrix(height, output_shape[0]) @ resized
+    if width != output_shape[1]:
+        resized = resized @ _resize_matrix(width, output_shape[1]).T
+    if resized is stack:
+        resized = stack.copy()
+
+    lowest = np.min(stack, axis=(1, 2), keepdims=True)
+    highest = np.max(stack, axis=(1, 2), keepdims=True)
+    return np.clip(resized, lowest, highest, out=resized)
+
+
+def masks2slices(masks, output_shape, threshold=0.95):
+    """
+    Binary network masks (N, size, size) rotated by -90 degrees, resized to output_shape and thresholded, as the
+    coronal slices of the exam volume. Empty masks are not resampled.
+    """
+    slices = np.zeros((len(masks), *output_shape), dtype=np.uint8)
+    nonEmpty = np.flatnonzero(masks.reshape(len(masks), -1).any(axis=1))
+    if len(nonEmpty):
+        resized = resize_stack(np.rot90(masks[nonEmpty], -1, axes=(1, 2)), output_shape)
+        slices[nonEmpty] = resized > threshold
+    return slices
+
+
 def get_array_affine_header(test_dataset):
-    array = np.zeros(test_dataset.exam.volume.shape, dtype=np.uint16)
+    array = np.zeros(test_dataset.exam.volume.shape, dtype=np.uint8)
     affine, header = test_dataset.exam.volume.affine, test_dataset.exam.volume.header
     return array, affine, header
 
 
 def prob2mask(prob):
-    mask = prob.squeeze().cpu().numpy()
+    mask = prob.squeeze(1).cpu().numpy()
     mask[mask < 0.5] = 0
     mask[mask >= 0.5] = 1
-    return mask.swapaxes(0, 1).astype(np.uint8)
+    return mask.swapaxes(1, 2).astype(np.uint8)
+
+
+def get_available_memory(device):
+    """memory in bytes available for inference on device, None if it cannot be probed"""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_resident_memory():
+    """resident memory of the process in bytes, None if it cannot be probed"""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def auto_batch_size(device, max_batch_size=32, memory_fraction=0.5, default_batch_size=4, memory=None):
+    """
+    largest number of slices whose forward pass fits in a fraction of the available memory, or of memory bytes if given
+    """
+    available = memory if memory is not None else get_available_memory(device)
+    if available is None:
+        return default_batch_size
+    return int(np.clip(available * memory_fraction // SLICE_MEMORY, 1, max_batch_size))
+
+
+def _boundingBox(segmentation):
+    """slices of the smallest box holding every non-zero voxel of segmentation"""
+    box = []
+    for axis in range(segmentation.ndim):
+        nonZero = np.flatnonzero(np.any(segmentation, axis=tuple(i for i in range(segmentation.ndim) if i != axis)))
+        box.append(slice(nonZero[0], nonZero[-1] + 1))
+    return tuple(box)
+
+
+def getConnectedAreas(segmentation, topK=None, minVoxels=0):
+    """
+    uint8 mask of the connected areas (6-connectivity) of segmentation having at least minVoxels voxels, restricted to
+    the topK largest ones if topK is not None. Ties are resolved in favor of the first area in scan order.
+    """
+    if not segmentation.any():
+        return np.zeros(segmentation.shape, dtype=np.uint8)  # never segmentation itself, which may still be written
+
+    box = _boundingBox(segmentation)
+    labels, _ = ndimage.label(segmentation[box], structure=ndimage.generate_binary_structure(segmentation.ndim, 1))
+    counts = np.bincount(labels.ravel())
+    counts[0] = 0  # background
+
+    kept = np.argsort(-counts, kind="stable")
+    kept = kept[counts[kept] >= max(minVoxels, 1)][:topK]
+    isKept = np.zeros(len(counts), dtype=bool)
+    isKept[kept] = True
+
+    areas = np.zeros(segmentation.shape, dtype=np.uint8)
+    areas[box] = isKept[labels]
+    return areas
 
 
 def getLargestConnectedArea(segmentation):
-    if len(np.unique(segmentation)) == 1:
-        return segmentation
-    else:
-        labels = label(segmentation, connectivity=1)
-        unique, counts = np.unique(labels, return_counts=True)
-        list_seg = list(zip(unique, counts))[1:]  # the 0 label is by default background so take the rest
-        largest = max(list_seg, key=lambda x: x[1])[0]
-        labels_max = (labels == largest).astype(int)
-        return labels_max
+    with profileStage("connected components"):
+        return getConnectedAreas(segmentation, topK=1)
@@ -0,0 +1,126 @@
+"""
+Agreement of approximated PKDIA networks (reduced precision, int8 quantization, ...) with the float32 one, e.g. from
+the SlicerPKDIALib directory, on the sample files :
+
+    python -m pkdia.validation T2SampleFile.nii.gz --modality T2 --weights ../weights/PKDIAv1-weights.pth
+"""
+
+import argparse
+import csv
+import logging
+import sys
+import time
+
+import nibabel
+import numpy as np
+
+from .nets.registry import PRECISIONS, loadPKDIANet
+from .PKDIA import applyPKDIAArray
+from .utils.modality import ModalityEnum
+
+VALIDATION_FIELDS = (
+    "exam",
+    "variant",
+    "dice_LK",
+    "dice_RK",
+    "volumeChange_LK",
+    "volumeChange_RK",
+    "seconds",
+    "speedup",
+)
+
+
+def dice(mask, referenceMask):
+    """Dice coefficient of two binary masks, 1 if both are empty"""
+    mask, referenceMask = mask.astype(bool, copy=False), referenceMask.astype(bool, copy=False)
+    total = np.count_nonzero(mask) + np.count_nonzero(referenceMask)
+    return 2 * np.count_nonzero(mask & referenceMask) / total if total else 1.0
+
+
+def volumeChange(mask, referenceMask):
+    """relative change of the segmented volume, in percent, 0 if both are empty"""
+    referenceVolume = np.count_nonzero(referenceMask)
+    if not referenceVolume:
+        return 0.0 if not np.count_nonzero(mask) else float("inf")
+    return 100 * (np.count_nonzero(mask) - referenceVolume) / referenceVolume
+
+
+def _timedSegmentation(image, modality, net, batchSize):
+    start = time.perf_counter()
+    arrays = applyPKDIAArray(image.get_fdata(dtype=np.float32), image.affine, modality, net=net, batchSize=batchSize)
+    return arrays, time.perf_counter() - start
+
+
+def compareNetworks(inputPaths, modality, referenceNet, nets, batchSize="auto"):
+    """
+    Segments every exam with the reference network and each of the named nets.
+    Returns one row per exam and net with the Dice and volume change of each kidney against the reference, and the
+    speedup of the net.
+    """
+    rows = []
+    for inputPath in inputPaths:
+        image = nibabel.load(inputPath)
+        referenceArrays, referenceSeconds = _timedSegmentation(image, modality, referenceNet, batchSize)
+        for variant, net in nets.items():
+            arrays, seconds = _timedSegmentation(image, modality, net, batchSize)
+            row = {"exam": str(inputPath), "variant": variant}
+            for kidney, array, referenceArray in zip(("LK", "RK"), arrays, referenceArrays):
+                row[f"dice_{kidney}"] = round(dice(array, referenceArray), 4)
+                row[f"volumeChange_{kidney}"] = round(volumeChange(array, referenceArray), 3)
+            row["seconds"] = round(seconds, 2)
+            row["speedup"] = round(referenceSeconds / seconds, 2)
+            logging.info(", ".join(f"{key}: {value}" for key, value in row.items()))
+            rows.append(row)
+    return rows
+
+
+def comparePrecisions(inputPaths, modality, weightsPath, precisions=("bf16", "fp16", "int8"), batchSize="auto"):
+    """
+    compareNetworks of the reduced precision and quantized networks against the float32 one, on the default device
+    except for int8 networks, which only run on CPU
+    """
+    referenceNet = loadPKDIANet(weightsPath)
+    nets = {
+        precision: loadPKDIANet(weightsPath, "cpu" if precision == "int8" else None, dtype=precision)
+        for precision in precisions
+    }
+    return compareNetworks(inputPaths, modality, referenceNet, nets, batchSize)
+
+
+def writeRows(rows, file):
+    writer = csv.DictWriter(file, VALIDATION_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pkdia.validation",
+        description="Agreement of reduced precision and int8 PKDIA networks with float32.",
+    )
+    parser.add_argument("inputs", nargs="+", help="NIfTI exams")
+    parser.add_argument("--modality", required=True, choices=[modality.name for modality in ModalityEnum])
+    parser.add_argument("--weights", required=True, help="PKDIA weights")
+    parser.add_argument(
+        "--precisions",
+        nargs="+",
+        default=["bf16", "fp16", "int8"],
+        choices=[precision for precision in PRECISIONS if precision != "fp32"],
+    )
+    parser.add_argument("--batch-size", default="auto", help="slices per forward pass, or 'auto'")
+    parser.add_argument("--csv", help="writes the results to this CSV file instead of the standard output")
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    batchSize = args.batch_size if args.batch_size == "auto" else int(args.batch_size)
+    rows = comparePrecisions(args.inputs, ModalityEnum[args.modality], args.weights, args.precisions, batchSize)
+    if args.csv is None:
+        writeRows(rows, sys.stdout)
+    else:
+        with open(args.csv, "w", newline="") as f:
+            writeRows(rows, f)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+from SlicerPKDIALib.BackgroundTask import BackgroundTask
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.nets import swinv2Unet
+from SlicerPKDIALib.pkdia.nets.registry import loadPKDIANet
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class BackgroundTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 6, 4))
+        self.image = nibabel.load(inputPath)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _segmentationTask(self, **kwargs):
+        net = loadPKDIANet(self.weightsPath)
+        return BackgroundTask(
+            PKDIA.applyPKDIAArray, self.image.get_fdata(), self.image.affine, ModalityEnum.T2, net=net, **kwargs
+        )
+
+    def test_signals_are_emitted_on_the_polling_thread(self):
+        emitted = []
+        task = self._segmentationTask(batchSize=2, then=lambda arrays: [array.sum() for array in arrays])
+        task.progress.connect(lambda *progress: emitted.append(("progress", progress, threading.get_ident())))
+        task.finished.connect(lambda result: emitted.append(("finished", result, threading.get_ident())))
+
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            task.start()
+            self.assertEqual(emitted, [])
+            self.assertFalse(task.wait())
+
+        self.assertTrue(task.isDone())
+        self.assertEqual([e[1] for e in emitted[:-1]], [(2, 6), (4, 6), (6, 6)])
+        self.assertEqual(emitted[-1][0], "finished")
+        self.assertTrue(all(e[2] == threading.get_ident() for e in emitted))
+
+    def test_cancellation_stops_the_slice_loop(self):
+        task = self._segmentationTask(batchSize=1)
+        task.progress.connect(lambda *_: task.cancel())
+        cancelled, finished = mock.Mock(), mock.Mock()
+        task.cancelled.connect(cancelled)
+        task.finished.connect(finished)
+
+        forward = swinv2Unet.SwinV2TwoDecoder.forward
+        with mock.patch.object(
+            swinv2Unet.SwinV2TwoDecoder, "forward", side_effect=forward, autospec=True
+        ) as mockForward:
+            task.start()
+            while task.poll():
+                time.sleep(0.01)
+
+        cancelled.assert_called_once_with()
+        finished.assert_not_called()
+        self.assertLess(mockForward.call_count, 6)
+
+    def test_partial_results_are_emitted_before_finished(self):
+        def function(progressCallback, cancelEvent):
+            for result in range(3):
+                task.postPartialResult(result)
+            return 3
+
+        emitted = []
+        task = BackgroundTask(function, thenPartial=lambda result: 10 * result)
+        task.partialResult.connect(lambda result: emitted.append(("partialResult", result, threading.get_ident())))
+        task.finished.connect(lambda result: emitted.append(("finished", result, threading.get_ident())))
+        self.assertFalse(task.start().wait())
+
+        self.assertEqual(
+            [e[:2] for e in emitted],
+            [("partialResult", 0), ("partialResult", 10), ("partialResult", 20), ("finished", 3)],
+        )
+        self.assertTrue(all(e[2] == threading.get_ident() for e in emitted))
+
+    def test_errors_are_reported_by_failed(self):
+        task = BackgroundTask(lambda progressCallback, cancelEvent: np.zeros(3)[5])
+        failed = mock.Mock()
+        task.failed.connect(failed)
+        task.start().wait()
+        self.assertIsInstance(failed.call_args[0][0], IndexError)
@@ -0,0 +1,128 @@
+"""
+Benchmarks of applyPKDIA on synthetic volumes with random weights, needing neither Slicer nor the network. Being slow,
+they are deselected by default (see pytest.ini) :
+
+    python -m pytest Testing/BenchmarkTestCase.py -m slow
+
+Each volume is segmented in a fresh process, whose throughput and peak memory increase (see Profiler) of every stage
+and of the whole applyPKDIA call are compared to the baselines of the machine in BenchmarkBaselines.json, regressions
+failing the run.
+Baselines are keyed by machineKey and the committed ones were only recorded on a single core Linux x86_64 machine :
+the benchmarks of other machines are skipped until PKDIA_BENCHMARK_SAVE=1 records their measures as their baselines.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+import torch
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.profiling import Profiler, profileStage
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+BASELINES_PATH = Path(__file__).parent / "BenchmarkBaselines.json"
+THROUGHPUT_TOLERANCE = 0.2  # relative throughput drop failing the benchmark, timings being noisy
+PEAK_MEMORY_TOLERANCE = 0.1  # relative increase of the memory of a stage failing the benchmark
+PEAK_MEMORY_SLACK = 16 * 2**20  # bytes, stages allocating little memory being compared to the allocator granularity
+BATCH_SIZE = 4  # the "auto" batch size would depend on the memory left free by the other processes
+MIN_TIMED_SECONDS = 1.0  # throughputs of stages faster in the baseline are too noisy to be compared
+
+
+def machineKey():
+    """baselines only hold for the machine, and the number of threads, they were measured with"""
+    return f"{platform.system()}-{platform.machine()}-{os.cpu_count()} cores-{torch.get_num_threads()} threads"
+
+
+def loadBaselines():
+    if not BASELINES_PATH.exists():
+        return {}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def saveBaselines(name, measures):
+    baselines = loadBaselines()
+    baselines.setdefault(machineKey(), {})[name] = measures
+    with open(BASELINES_PATH, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def benchmarkApplyPKDIA(inputPath, outputDir, weightsPath, slices):
+    """slices per second and peak memory increase of each applyPKDIA stage, and of the whole call"""
+    profiler = Profiler()
+    with profiler.activate(), profileStage("applyPKDIA"):
+        PKDIA.applyPKDIA(inputPath, outputDir, ModalityEnum.T2, weightsPath, batchSize=BATCH_SIZE)
+    return {
+        profile.name: {
+            "seconds": round(profile.wallSeconds, 3),
+            "slicesPerSecond": round(slices / profile.wallSeconds, 3),
+            "peakIncreaseBytes": profile.peakIncreaseBytes,
+        }
+        for profile in profiler.stages.values()
+    }
+
+
+def benchmarkInNewProcess(*args):
+    """benchmarkApplyPKDIA in a new process, whose memory and caches are not the ones left by the previous tests"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(benchmarkApplyPKDIA, *args).result()
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.TemporaryDirectory()
+        cls.tempPath = Path(cls.tempDir.name)
+        cls.weightsPath = createRandomWeights(cls.tempPath / "weights.pth")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempDir.cleanup()
+
+    def _benchmark(self, shape):
+        name = "x".join(map(str, shape))
+        inputPath = createSyntheticVolume(self.tempPath / f"volume-{name}.nii.gz", shape=shape)
+        measures = benchmarkInNewProcess(inputPath, self.tempPath / "output", self.weightsPath, shape[1])
+        inputPath.unlink()
+
+        if os.environ.get("PKDIA_BENCHMARK_SAVE"):
+            saveBaselines(name, measures)
+            return
+
+        baseline = loadBaselines().get(machineKey(), {}).get(name)
+        if baseline is None:
+            self.skipTest(f"no {name} baseline for {machineKey()}, record them with PKDIA_BENCHMARK_SAVE=1")
+        for stage, measure in measures.items():
+            expected = baseline.get(stage)
+            if expected is None:
+                continue
+            with self.subTest(stage=stage):
+                if expected["seconds"] >= MIN_TIMED_SECONDS:
+                    self.assertGreaterEqual(
+                        measure["slicesPerSecond"], (1 - THROUGHPUT_TOLERANCE) * expected["slicesPerSecond"]
+                    )
+                self.assertLessEqual(
+                    measure["peakIncreaseBytes"],
+                    (1 + PEAK_MEMORY_TOLERANCE) * expected["peakIncreaseBytes"] + PEAK_MEMORY_SLACK,
+                )
+
+    @pytest.mark.slow
+    def test_256x64x256_volume(self):
+        self._benchmark((256, 64, 256))
+
+    @pytest.mark.slow
+    def test_384x160x384_volume(self):
+        self._benchmark((384, 160, 384))
+
+    @pytest.mark.slow
+    def test_512x400x512_volume(self):
+        self._benchmark((512, 400, 512))
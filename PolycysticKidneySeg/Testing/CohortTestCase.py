@@ -0,0 +1,187 @@
+import csv
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+from SlicerPKDIALib.pkdia import __main__ as cli
+from SlicerPKDIALib.pkdia import cohort
+from SlicerPKDIALib.pkdia.nets import swinv2Unet
+from SlicerPKDIALib.pkdia.pipeline import Pipeline
+from SlicerPKDIALib.pkdia.PKDIA import predictionPaths
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+def crashingSegmentInWorker(inputPath, *args):
+    """cohort._segmentInWorker whose worker process dies on the crash exam"""
+    if os.path.basename(inputPath).startswith("crash"):
+        os._exit(1)
+    return cohort._segmentInWorker(inputPath, *args)
+
+
+class CohortTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+        self.inputDir = self.tempPath / "exams"
+        self.inputDir.mkdir()
+        self.outputDir = self.tempPath / "predictions"
+        self.exams = [
+            str(createSyntheticVolume(self.inputDir / f"exam{i}.nii.gz", shape=(48, 3, 4), seed=i)) for i in range(2)
+        ]
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _main(self, *args):
+        arguments = [str(self.inputDir), "--modality", "T2", "--output", str(self.outputDir)]
+        arguments += ["--weights", str(self.weightsPath), *args]
+        loadPKDIANet = cohort.loadPKDIANet
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward), mock.patch.object(
+            cohort, "loadPKDIANet", side_effect=loadPKDIANet
+        ) as mockLoad:
+            returnCode = cli.main(arguments)
+        with open(self.outputDir / "summary.csv", newline="") as f:
+            rows = list(csv.DictReader(f))
+        return returnCode, rows, mockLoad.call_count
+
+    def test_exams_are_listed_from_directories_and_patterns(self):
+        (self.inputDir / "exam0-prediction-LK.nii.gz").touch()
+        (self.inputDir / "notes.txt").touch()
+        self.assertEqual(cohort.listExams(self.inputDir), self.exams)
+        self.assertEqual(cohort.listExams([str(self.inputDir / "*1.nii.gz")]), self.exams[1:])
+        self.assertEqual(cohort.listExams([self.inputDir, self.exams[0]]), self.exams)
+
+    def test_exams_with_the_same_file_name_are_rejected(self):
+        (self.inputDir / "site").mkdir()
+        createSyntheticVolume(self.inputDir / "site" / "exam0.nii.gz", shape=(48, 3, 4))
+        with self.assertRaisesRegex(ValueError, "same file name"):
+            cohort.listExams([self.inputDir, self.inputDir / "site"])
+        arguments = [str(self.inputDir), str(self.inputDir / "site"), "--modality", "T2"]
+        arguments += ["--output", str(self.outputDir)]
+        self.assertEqual(cli.main(arguments), 1)
+        self.assertFalse(self.outputDir.exists())
+
+    def test_cohort_is_segmented_with_a_single_model_and_summarized(self):
+        returnCode, rows, loadCount = self._main()
+
+        self.assertEqual(returnCode, 0)
+        self.assertEqual(loadCount, 1)
+        self.assertEqual([row["exam"] for row in rows], self.exams)
+        self.assertEqual({row["status"] for row in rows}, {"segmented"})
+        for exam in self.exams:
+            self.assertTrue(all(Path(path).exists() for path in predictionPaths(exam, str(self.outputDir))))
+
+    def test_memory_budget_streams_the_exams(self):
+        with mock.patch.object(cohort, "applyPKDIAStreaming", side_effect=cohort.applyPKDIAStreaming) as mockStreaming:
+            returnCode, rows, _ = self._main("--memory-budget", "1.5T")
+
+        self.assertEqual(returnCode, 0)
+        self.assertEqual({row["status"] for row in rows}, {"segmented"})
+        self.assertEqual([call.args[4] for call in mockStreaming.call_args_list], [int(1.5 * 2**40)] * 2)
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            cli.parseArguments(["exam.nii", "--modality", "T2", "--output", "out", "--memory-budget", "lots"])
+
+    def test_existing_predictions_are_skipped(self):
+        self._main()
+        returnCode, rows, loadCount = self._main()
+
+        self.assertEqual(returnCode, 0)
+        self.assertEqual(loadCount, 0)
+        self.assertEqual([row["status"] for row in rows[2:]], ["skipped", "skipped"])
+
+    def test_failing_exam_does_not_stop_the_cohort(self):
+        (self.inputDir / "corrupted.nii.gz").write_bytes(b"not a NIfTI file")
+        returnCode, rows, _ = self._main()
+
+        self.assertEqual(returnCode, 1)
+        statuses = {Path(row["exam"]).name: row["status"] for row in rows}
+        self.assertEqual(
+            statuses, {"corrupted.nii.gz": "failed", "exam0.nii.gz": "segmented", "exam1.nii.gz": "segmented"}
+        )
+
+    def test_parallel_workers_isolate_failures_and_report_throughput(self):
+        (self.inputDir / "corrupted.nii.gz").write_bytes(b"not a NIfTI file")
+        exams = cohort.listExams(self.inputDir)
+
+        with self.assertLogs(level="INFO") as logs:
+            rows = cohort.segmentCohortInParallel(
+                exams,
+                str(self.outputDir),
+                ModalityEnum.T2,
+                self.weightsPath,
+                workers=2,
+                threadsPerWorker=1,
+                batchSize=4,
+            )
+
+        statuses = {Path(row["exam"]).name: row["status"] for row in rows}
+        self.assertEqual(
+            statuses, {"corrupted.nii.gz": "failed", "exam0.nii.gz": "segmented", "exam1.nii.gz": "segmented"}
+        )
+        for exam in self.exams:
+            self.assertTrue(all(Path(path).exists() for path in predictionPaths(exam, str(self.outputDir))))
+        self.assertTrue(any("exams/hour" in message for message in logs.output))
+
+    def test_dead_worker_only_fails_its_own_exam(self):
+        crashPath = str(createSyntheticVolume(self.inputDir / "crash.nii.gz", shape=(48, 3, 4)))
+        exams = cohort.listExams(self.inputDir)
+
+        with mock.patch.object(cohort, "_segmentInWorker", crashingSegmentInWorker):
+            rows = cohort.segmentCohortInParallel(
+                exams, str(self.outputDir), ModalityEnum.T2, self.weightsPath, workers=2, threadsPerWorker=1
+            )
+
+        statuses = {row["exam"]: row["status"] for row in rows}
+        self.assertEqual(statuses, {crashPath: "failed", **dict.fromkeys(self.exams, "segmented")})
+        self.assertIn("BrokenProcessPool", rows[[row["exam"] for row in rows].index(crashPath)]["error"])
+
+    def test_throughput_only_counts_segmented_exams(self):
+        rows = [{"status": "segmented"}, {"status": "skipped"}, {"status": "failed"}, {"status": "segmented"}]
+        self.assertAlmostEqual(cohort.reportThroughput(rows, 60), 120)
+
+    def test_pipeline_overlaps_stages_and_passes_errors_along(self):
+        def sleepy(name):
+            def stage(value):
+                time.sleep(0.1)
+                if value == 2 and name == "read":
+                    raise ValueError(value)
+                return value
+
+            return name, stage
+
+        pipeline = Pipeline([sleepy("read"), sleepy("infer"), sleepy("write")])
+        start = time.perf_counter()
+        results = list(pipeline.run(range(5)))
+        duration = time.perf_counter() - start
+
+        self.assertEqual([(item, value) for item, value, _ in results], [(0, 0), (1, 1), (2, None), (3, 3), (4, 4)])
+        self.assertIsInstance(results[2][2], ValueError)
+        self.assertLess(duration, 0.8 * 1.5)  # 1.5s one stage after the other
+        self.assertEqual([metrics.items for metrics in pipeline.metrics], [5, 4, 4])
+        self.assertEqual(pipeline.metrics[0].asDict()["stage"], "read")
+
+    def test_pipelined_and_sequential_cohorts_write_the_same_predictions(self):
+        sequentialDir, pipelinedDir = self.tempPath / "sequential", self.tempPath / "pipelined"
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            cohort.segmentCohort(self.exams, str(sequentialDir), ModalityEnum.T2, self.weightsPath, prefetch=0)
+            with self.assertLogs(level="INFO") as logs:
+                cohort.segmentCohort(self.exams, str(pipelinedDir), ModalityEnum.T2, self.weightsPath, prefetch=1)
+
+        for exam in self.exams:
+            for sequentialPath, pipelinedPath in zip(
+                predictionPaths(exam, str(sequentialDir)), predictionPaths(exam, str(pipelinedDir))
+            ):
+                np.testing.assert_array_equal(
+                    np.asanyarray(nibabel.load(sequentialPath).dataobj),
+                    np.asanyarray(nibabel.load(pipelinedPath).dataobj),
+                )
+        self.assertTrue(any("bottleneck" in message for message in logs.output))
@@ -0,0 +1,54 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import nibabel
+import numpy as np
+import torch
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.export import exportPKDIANet
+from SlicerPKDIALib.pkdia.nets.registry import exportedPath, loadPKDIANet
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_exported_network_replaces_the_eager_one(self):
+        self.assertIsInstance(loadPKDIANet(self.weightsPath, "cpu"), torch.nn.Module)
+        path = exportPKDIANet(self.weightsPath)
+        self.assertEqual(path, exportedPath(self.weightsPath))
+        self.assertEqual(path.parent, self.weightsPath.parent)
+
+        net = loadPKDIANet(self.weightsPath, "cpu")
+        self.assertIsInstance(net, torch.jit.ScriptModule)
+        self.assertNotIsInstance(loadPKDIANet(self.weightsPath, "cpu", exported=False), torch.jit.ScriptModule)
+        self.assertNotIsInstance(loadPKDIANet(self.weightsPath, "cpu", "int8"), torch.jit.ScriptModule)
+
+        image = nibabel.load(createSyntheticVolume(self.tempPath / "exam.nii.gz", shape=(48, 5, 4)))
+        data = image.get_fdata(dtype=np.float32)
+        eager = loadPKDIANet(self.weightsPath, "cpu", exported=False)
+        expected = PKDIA.applyPKDIAArray(data, image.affine, ModalityEnum.T2, net=eager, batchSize=2)
+        arrays = PKDIA.applyPKDIAArray(data, image.affine, ModalityEnum.T2, net=net, batchSize=4)
+        for array, expectedArray in zip(arrays, expected):
+            np.testing.assert_array_equal(array, expectedArray)
+
+    def test_export_is_keyed_by_the_weights_checksum(self):
+        path = exportPKDIANet(self.weightsPath)
+        createRandomWeights(self.weightsPath, seed=1)
+        self.assertNotEqual(exportedPath(self.weightsPath), path)
+        self.assertNotIsInstance(loadPKDIANet(self.weightsPath, "cpu"), torch.jit.ScriptModule)
+
+    def test_unreadable_export_falls_back_to_eager(self):
+        exportedPath(self.weightsPath).write_bytes(b"not a TorchScript archive")
+        with self.assertLogs(level="WARNING"):
+            net = loadPKDIANet(self.weightsPath, "cpu")
+        self.assertNotIsInstance(net, torch.jit.ScriptModule)
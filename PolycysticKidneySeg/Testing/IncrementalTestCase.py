@@ -0,0 +1,97 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.incremental import IncrementalSegmentation, examSlices
+from SlicerPKDIALib.pkdia.nets.registry import loadPKDIANet
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class IncrementalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.net = loadPKDIANet(createRandomWeights(self.tempPath / "weights.pth"), "cpu")
+        self.forward = mock.Mock(side_effect=lambda x: sliceWiseForward(None, x))
+        self.patcher = mock.patch.object(self.net, "forward", self.forward)
+        self.patcher.start()
+
+        image = nibabel.load(createSyntheticVolume(self.tempPath / "exam.nii.gz", shape=(48, 12, 40)))
+        self.array = image.get_fdata(dtype=np.float32)
+        # non canonical geometry, as Slicer LPS volumes
+        self.affine = image.affine @ np.diag([-1, -1, 1, 1])
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tempDir.cleanup()
+
+    def _segmentedSlices(self):
+        return sum(len(call.args[0]) for call in self.forward.call_args_list)
+
+    def _assertMatchesFullSegmentation(self, arrays, array, modality):
+        expected = PKDIA.applyPKDIAArray(array, self.affine, modality, net=self.net, batchSize=4)
+        for labels, expectedLabels in zip(arrays, expected):
+            np.testing.assert_array_equal(labels, expectedLabels)
+
+    def test_exam_slices_of_a_region(self):
+        mask = np.zeros(self.array.shape, dtype=bool)
+        mask[:, 2:4, :] = True
+        np.testing.assert_array_equal(examSlices(mask, self.affine, ModalityEnum.T2), [8, 9])  # j axis flipped
+        np.testing.assert_array_equal(examSlices(mask, self.affine, ModalityEnum.CT), np.arange(40))
+
+    def test_only_modified_slices_are_segmented_again(self):
+        for modality in ModalityEnum:
+            with self.subTest(modality=modality):
+                self.forward.reset_mock()
+                session = IncrementalSegmentation(modality, self.net, batchSize=4)
+                array_LK, array_RK, changed = session.segment(self.array, self.affine)
+                self.assertEqual(changed, (True, True))
+                self.assertTrue(array_LK.any())
+                self._assertMatchesFullSegmentation((array_LK, array_RK), self.array, modality)
+
+                self.forward.reset_mock()
+                array_LK, array_RK, changed = session.segment(self.array, self.affine)
+                self.assertEqual(changed, (False, False))
+                self.assertEqual(self._segmentedSlices(), 0)
+
+                edited = self.array.copy()
+                edited[20:30, 5, 10:20] = 0
+                self.forward.reset_mock()
+                arrays = session.segment(edited, self.affine)
+                self.assertEqual(self._segmentedSlices(), 1 if modality == ModalityEnum.T2 else 10)
+                self._assertMatchesFullSegmentation(arrays[:2], edited, modality)
+
+                # edits in place of the last segmented array, as Slicer ones, are found too
+                edited[20:30, 7, 10:20] = 0
+                self.forward.reset_mock()
+                arrays = session.segment(edited, self.affine)
+                self.assertEqual(self._segmentedSlices(), 1 if modality == ModalityEnum.T2 else 10)
+                self._assertMatchesFullSegmentation(arrays[:2], edited, modality)
+
+                self.forward.reset_mock()
+                session.segment(edited, self.affine, region=(slice(None), slice(0, 3), slice(None)))
+                self.assertEqual(self._segmentedSlices(), 3 if modality == ModalityEnum.T2 else 40)
+
+    def test_cancelled_update_keeps_the_last_results(self):
+        session = IncrementalSegmentation(ModalityEnum.T2, self.net, batchSize=1)
+        session.segment(self.array, self.affine)
+
+        edited = self.array.copy()
+        edited[:, 3:6, :] = 0
+        cancelEvent = threading.Event()
+        with self.assertRaises(PKDIA.InferenceCancelledError):
+            session.segment(edited, self.affine, progressCallback=lambda *_: cancelEvent.set(), cancelEvent=cancelEvent)
+
+        self.forward.reset_mock()
+        arrays = session.segment(edited, self.affine)
+        self.assertEqual(self._segmentedSlices(), 3)
+        self.assertEqual(arrays[2], (True, True))
+        self._assertMatchesFullSegmentation(arrays[:2], edited, ModalityEnum.T2)
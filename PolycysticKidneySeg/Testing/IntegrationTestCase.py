@@ -27,6 +27,8 @@ class IntegrationTestCase(unittest.TestCase):
         widget.ui.modalityComboBox.setCurrentIndex(0)  # T2
 
         widget.ui.applyButton.click()
+        while widget.isSegmentationRunning():
+            slicer.app.processEvents()
 
         segmentations = list(slicer.mrmlScene.GetNodesByClass("vtkMRMLSegmentationNode"))
         self.assertEqual(len(segmentations), 1)
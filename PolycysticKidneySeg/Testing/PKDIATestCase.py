@@ -0,0 +1,454 @@
+import tempfile
+import time
+import tracemalloc
+import unittest
+from itertools import chain
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+import pytest
+import torch
+from skimage.measure import label
+from skimage.transform import resize, rotate
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.datasets.dataset_genkyst import tiny_dataset_genkyst_prod
+from SlicerPKDIALib.pkdia.exams.exam_genkyst_prod import exam_genkyst_prod
+from SlicerPKDIALib.pkdia.nets import block, swinv2Unet
+from SlicerPKDIALib.pkdia.nets.registry import ModelRegistry, loadPKDIANet
+from SlicerPKDIALib.pkdia.utils import utils
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+from SlicerPKDIALib.pkdia.utils.utils import (
+    getConnectedAreas,
+    getLargestConnectedArea,
+    masks2slices,
+    prob2mask,
+)
+
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+def sliceWiseForward(_, x):
+    """Cheap stand-in for SwinV2TwoDecoder.forward, whose logits of a slice don't depend on the rest of the batch"""
+    return x - x.mean(dim=(1, 2, 3), keepdim=True), x.flip(-1) - x.mean(dim=(1, 2, 3), keepdim=True)
+
+
+def legacyPredictions(inputPath, outputDir, modality, weightsPath):
+    """Reference implementation of the original applyPKDIA slice loop, running the network once per kidney."""
+    net = swinv2Unet.SwinV2TwoDecoder(
+        model_name="swinv2_cr_tiny_ns_224", img_size=(256, 256), in_chans=1, n_classes_1dec=1, n_classes_2dec=1
+    )
+    net.load_state_dict(torch.load(weightsPath, map_location="cpu", weights_only=True))
+    dataset = tiny_dataset_genkyst_prod(inputPath, outputDir, 256, modality)
+    shape = dataset.exam.volume.shape
+    array_LK = np.zeros(shape, dtype=np.uint16)
+    array_RK = array_LK.copy()
+
+    with torch.no_grad():
+        for idx in range(len(dataset)):
+            image = torch.from_numpy(dataset[idx][0][None]).to(dtype=torch.float32)
+            for array, iKidney in ((array_LK, 0), (array_RK, 1)):
+                mask = prob2mask(torch.sigmoid(net(image)[iKidney]))[0]
+                mask = rotate(mask, -90, preserve_range=True)
+                mask = resize(mask, output_shape=(shape[0], shape[2]), preserve_range=True)
+                mask[np.where(mask > 0.95)] = 1
+                mask[np.where(mask != 1)] = 0
+                array[0 : shape[0], idx, 0 : shape[2]] = mask[::-1, ::]
+
+    return getLargestConnectedArea(array_LK), getLargestConnectedArea(array_RK)
+
+
+def legacyLargestConnectedArea(segmentation):
+    """Reference implementation of the original getLargestConnectedArea."""
+    if len(np.unique(segmentation)) == 1:
+        return segmentation
+    labels = label(segmentation, connectivity=1)
+    unique, counts = np.unique(labels, return_counts=True)
+    largest = max(list(zip(unique, counts))[1:], key=lambda x: x[1])[0]
+    return (labels == largest).astype(int)
+
+
+def legacyLabelVolumes(array_LK, array_RK):
+    """Reference implementation of the original applyPKDIA label combination, on uint16 volumes."""
+    array_nopp = array_LK + array_RK
+    array_nopp[np.where(array_nopp > 0.0)] = 1
+    array_nopp = array_nopp.astype(np.uint16)
+    array_LK = legacyLargestConnectedArea(array_LK)
+    array_RK = legacyLargestConnectedArea(array_RK)
+    array = array_LK + array_RK
+    array[np.where(array > 0.0)] = 1
+    return array_LK.astype(np.uint16), array_RK.astype(np.uint16), array.astype(np.uint16), array_nopp
+
+
+def kidneyMasks(shape, dtype):
+    """Two ellipsoidal kidney masks, each with a small spurious blob"""
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    masks = []
+    for center in (0.3, 0.7):
+        mask = sum(((g - c * n) / (0.15 * n)) ** 2 for g, c, n in zip(grid, (center, 0.5, 0.5), shape)) <= 1
+        mask[:3, :3, :3] = True
+        masks.append(mask.astype(dtype))
+    return masks
+
+
+def peakMemory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class PKDIATestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _applyPKDIA(self, inputPath, modality, **kwargs):
+        outputDir = self.tempPath / "output"
+        predLKPath, predRKPath, _, _ = PKDIA.applyPKDIA(
+            str(inputPath), str(outputDir), modality, self.weightsPath, **kwargs
+        )
+        return np.asanyarray(nibabel.load(predLKPath).dataobj), np.asanyarray(nibabel.load(predRKPath).dataobj)
+
+    def test_masks_are_identical_to_legacy_double_forward(self):
+        for modality in ModalityEnum:
+            with self.subTest(modality=modality):
+                inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 3, 4))
+                array_LK, array_RK = self._applyPKDIA(inputPath, modality, batchSize=1)
+                legacy_LK, legacy_RK = legacyPredictions(str(inputPath), str(self.tempPath), modality, self.weightsPath)
+
+                np.testing.assert_array_equal(array_LK, legacy_LK)
+                np.testing.assert_array_equal(array_RK, legacy_RK)
+
+    def test_network_runs_once_per_slice(self):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 3, 4))
+        forward = swinv2Unet.SwinV2TwoDecoder.forward
+        with mock.patch.object(
+            swinv2Unet.SwinV2TwoDecoder, "forward", side_effect=forward, autospec=True
+        ) as mockForward:
+            self._applyPKDIA(inputPath, ModalityEnum.T2, batchSize=1)
+        self.assertEqual(mockForward.call_count, 3)
+
+    def test_batched_slices_are_written_back_to_their_coronal_index(self):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 5, 40))
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            expected_LK, expected_RK = self._applyPKDIA(inputPath, ModalityEnum.T2, batchSize=1)
+            array_LK, array_RK = self._applyPKDIA(inputPath, ModalityEnum.T2, batchSize=2)
+
+        self.assertTrue(expected_LK.any())
+        np.testing.assert_array_equal(array_LK, expected_LK)
+        np.testing.assert_array_equal(array_RK, expected_RK)
+
+    def test_batched_postprocessing_matches_slice_postprocessing(self):
+        rows, columns = np.mgrid[:256, :256]
+        masks = np.stack([(rows - 90 - 8 * i) ** 2 + (columns - 128) ** 2 < (30 + 4 * i) ** 2 for i in range(6)])
+        masks[2] = False
+        for shape in [(48, 40), (512, 400), (300, 5)]:
+            with self.subTest(shape=shape):
+                expected = []
+                for mask in masks.astype(np.uint8):
+                    mask = resize(rotate(mask, -90, preserve_range=True), output_shape=shape, preserve_range=True)
+                    mask[np.where(mask > 0.95)] = 1
+                    mask[np.where(mask != 1)] = 0
+                    expected.append(mask)
+                np.testing.assert_array_equal(masks2slices(masks.astype(np.uint8), shape), np.stack(expected))
+
+    def test_label_volumes_are_uint8_and_match_legacy_ones(self):
+        array_LK, array_RK = kidneyMasks((40, 30, 20), np.uint8)
+        array_nopp = np.logical_or(array_LK, array_RK).view(np.uint8)
+        expected = legacyLabelVolumes(array_LK.astype(np.uint16), array_RK.astype(np.uint16))
+
+        for array, expectedArray in zip((*PKDIA.postprocessPKDIA(array_LK, array_RK), array_nopp), expected):
+            self.assertEqual(array.dtype, np.uint8)
+            np.testing.assert_array_equal(array, expectedArray)
+
+    def test_predictions_are_saved_as_uint8(self):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 3, 4))
+        outputDir = self.tempPath / "output"
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            paths = PKDIA.applyPKDIA(str(inputPath), str(outputDir), ModalityEnum.T2, self.weightsPath)
+        for path in paths:
+            self.assertEqual(nibabel.load(path).get_data_dtype(), np.uint8)
+
+    def test_largest_connected_area_matches_legacy(self):
+        rng = np.random.default_rng(0)
+        for density in (0.0, 0.1, 0.3, 1.0):
+            for _ in range(10):
+                with self.subTest(density=density):
+                    segmentation = (rng.random((6, 7, 5)) < density).astype(np.uint8)
+                    np.testing.assert_array_equal(
+                        getLargestConnectedArea(segmentation), legacyLargestConnectedArea(segmentation)
+                    )
+
+    def test_connected_areas_selection(self):
+        segmentation = np.zeros((10, 10, 10), dtype=np.uint8)
+        segmentation[1:3, 1:3, 1:3] = 1  # 8 voxels
+        segmentation[5:8, 5:8, 5:8] = 1  # 27 voxels
+        segmentation[9, 9, 0:4] = 1  # 4 voxels
+
+        self.assertEqual(getConnectedAreas(segmentation).sum(), 39)
+        self.assertEqual(getConnectedAreas(segmentation, topK=1).sum(), 27)
+        self.assertEqual(getConnectedAreas(segmentation, topK=2).sum(), 35)
+        self.assertEqual(getConnectedAreas(segmentation, minVoxels=5).sum(), 35)
+        self.assertEqual(getConnectedAreas(segmentation, topK=1, minVoxels=30).sum(), 0)
+        self.assertEqual(getConnectedAreas(segmentation).dtype, np.uint8)
+
+        empty = np.zeros_like(segmentation)
+        self.assertFalse(np.shares_memory(getConnectedAreas(empty), empty))
+
+    @pytest.mark.slow
+    def test_largest_connected_area_is_faster_than_legacy(self):
+        segmentation, _ = kidneyMasks((512, 512, 200), np.uint8)
+
+        start = time.perf_counter()
+        expected = legacyLargestConnectedArea(segmentation)
+        legacyDuration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        largest = getLargestConnectedArea(segmentation)
+        duration = time.perf_counter() - start
+
+        np.testing.assert_array_equal(largest, expected)
+        self.assertLess(duration, 0.5 * legacyDuration)
+
+    @pytest.mark.slow
+    def test_label_volumes_peak_memory_drops(self):
+        def labelVolumes(array_LK, array_RK):
+            array = np.logical_or(array_LK, array_RK).view(np.uint8)
+            PKDIA.postprocessPKDIA(array_LK, array_RK, out=array)
+
+        shape = (512, 512, 400)
+        legacyPeak = peakMemory(legacyLabelVolumes, *kidneyMasks(shape, np.uint16))
+        peak = peakMemory(labelVolumes, *kidneyMasks(shape, np.uint8))
+        self.assertLess(peak, 0.7 * legacyPeak)
+
+    def test_localizer_skips_slices_without_kidneys(self):
+        data = np.zeros((48, 40, 40), dtype=np.float32)
+        data[10:30, 10:21, 10:30] = 100 + np.random.default_rng(0).normal(size=(20, 11, 20))
+        image = nibabel.Nifti1Image(data, affine=np.eye(4))
+        segmentedSlices = []
+
+        def brightForward(_, x):
+            segmentedSlices.append(len(x))
+            return 10 * x - 5, 10 * x - 5
+
+        net = loadPKDIANet(self.weightsPath)
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", brightForward):
+            expected = PKDIA.applyPKDIAArray(data, image.affine, ModalityEnum.T2, net=net, batchSize=4)
+            self.assertEqual(sum(segmentedSlices), 40)
+            segmentedSlices.clear()
+            with self.assertLogs(level="INFO") as logs:
+                arrays = PKDIA.applyPKDIAArray(data, image.affine, ModalityEnum.T2, net=net, localizerStride=4)
+
+        self.assertTrue(expected[0][:, 10:21, :].any())
+        self.assertFalse(expected[0][:, 21:, :].any())
+        for array, expectedArray in zip(arrays, expected):
+            np.testing.assert_array_equal(array, expectedArray)
+        self.assertLessEqual(sum(segmentedSlices), 0.6 * 40)
+        self.assertIn(f"skipped {40 - sum(segmentedSlices)} of 40", logs.output[0])
+
+    def test_preview_is_interpolated_then_refined(self):
+        data = np.zeros((48, 40, 40), dtype=np.float32)
+        data[10:30, 10:21, 10:30] = 100 + np.random.default_rng(0).normal(size=(20, 11, 20))
+        image = nibabel.Nifti1Image(data, affine=np.eye(4))
+        segmentedSlices, previews = [], []
+
+        def brightForward(_, x):
+            segmentedSlices.append(len(x))
+            return 10 * x - 5, 10 * x - 5
+
+        net = loadPKDIANet(self.weightsPath)
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", brightForward):
+            expected = PKDIA.applyPKDIAArray(data, image.affine, ModalityEnum.T2, net=net, batchSize=4)
+            segmentedSlices.clear()
+            arrays = PKDIA.applyPKDIAArray(
+                data,
+                image.affine,
+                ModalityEnum.T2,
+                net=net,
+                batchSize=4,
+                previewStride=4,
+                previewCallback=lambda *preview: previews.append([array.copy() for array in preview]),
+            )
+
+        self.assertEqual(sum(segmentedSlices), 40)
+        self.assertEqual(segmentedSlices[:3], [4, 4, 2])  # the coarse pass comes first
+        self.assertEqual(len(previews), 4)
+        for array, expectedArray in zip(arrays, expected):
+            np.testing.assert_array_equal(array, expectedArray)
+
+        errors = [np.count_nonzero(preview[0] != expected[0]) for preview in previews]
+        np.testing.assert_array_equal(previews[0][0][:, ::4, :], expected[0][:, ::4, :])
+        self.assertLess(errors[0], 0.25 * np.count_nonzero(expected[0]))  # at most the two slices around each border
+        self.assertEqual(errors, sorted(errors, reverse=True))
+
+    def test_interpolated_probabilities(self):
+        coarseMaps = np.zeros((2, 3, 2, 2), dtype=np.float16)
+        coarseMaps[:, 1] = 1
+        interpolated = PKDIA._interpolatedProbabilities(coarseMaps, np.array([0, 4, 8]), np.array([1, 2, 7]))
+        np.testing.assert_allclose(interpolated[:, :, 0, 0], [[0.25, 0.5, 0.25]] * 2)
+        interpolated = PKDIA._interpolatedProbabilities(coarseMaps[:, :2], np.array([0, 4]), np.array([6, 8]))
+        np.testing.assert_allclose(interpolated[:, :, 0, 0], [[1, 1]] * 2)
+
+    def test_array_api_matches_file_api_in_input_voxel_grid(self):
+        # Non canonical orientation: i along posterior, j along superior, k along left
+        affine = np.array([[0, 0, -0.8, 10], [-2, 0, 0, 5], [0, 0.9, 0, -3], [0, 0, 0, 1]])
+        rng = np.random.default_rng(0)
+        inputPath = self.tempPath / "oblique.nii.gz"
+        nibabel.save(nibabel.Nifti1Image(rng.normal(100, 30, size=(5, 36, 4)).astype(np.int16), affine), inputPath)
+        array = np.asanyarray(nibabel.load(inputPath).dataobj)
+
+        for modality in ModalityEnum:
+            with self.subTest(modality=modality), mock.patch.object(
+                swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward
+            ):
+                outputDir = self.tempPath / "output"
+                predLKPath, predRKPath, _, _ = PKDIA.applyPKDIA(inputPath, outputDir, modality, self.weightsPath)
+                array_LK, array_RK = PKDIA.applyPKDIAArray(array, affine, modality, self.weightsPath)
+
+                for arrayKidney, predPath in ((array_LK, predLKPath), (array_RK, predRKPath)):
+                    prediction = nibabel.load(predPath)
+                    self.assertEqual(arrayKidney.shape, array.shape)
+                    self.assertTrue(arrayKidney.any())
+
+                    # Voxels of the input grid and of the saved prediction sharing the same RAS position
+                    ijk = np.indices(array.shape).reshape(3, -1)
+                    toPrediction = np.linalg.inv(prediction.affine) @ affine
+                    predIjk = np.rint(toPrediction[:3, :3] @ ijk + toPrediction[:3, 3:]).astype(int)
+                    np.testing.assert_array_equal(arrayKidney[tuple(ijk)], prediction.get_fdata()[tuple(predIjk)])
+
+        np.testing.assert_array_equal(array, np.asanyarray(nibabel.load(inputPath).dataobj))
+
+    def test_canonical_volume_is_only_written_on_demand(self):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 2, 4))
+        prodPath = self.tempPath / "output" / "volume-prod.nii.gz"
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            self._applyPKDIA(inputPath, ModalityEnum.CT)
+            self.assertFalse(prodPath.exists())
+
+            self._applyPKDIA(inputPath, ModalityEnum.CT, saveArtifacts=True)
+            self.assertEqual(nibabel.load(prodPath).get_data_dtype(), np.float32)
+
+    def test_exam_keeps_float32_data_not_aliasing_the_input(self):
+        array = np.random.default_rng(0).normal(size=(8, 6, 4))
+        for modality in ModalityEnum:
+            for dtype in (np.float32, np.float64):
+                with self.subTest(modality=modality, dtype=dtype):
+                    image = nibabel.Nifti1Image(array.astype(dtype), np.eye(4))
+                    exam = exam_genkyst_prod(None, None, modality, image)
+                    exam.normalize()
+                    self.assertEqual(exam.data.dtype, np.float32)
+                    self.assertFalse(np.shares_memory(exam.data, image.dataobj))
+                    np.testing.assert_array_equal(image.dataobj, array.astype(dtype))
+
+    def test_batched_forward_matches_slice_by_slice_forward(self):
+        torch.manual_seed(0)
+        net = swinv2Unet.SwinV2TwoDecoder(model_name="swinv2_cr_tiny_ns_224", img_size=(256, 256), in_chans=1)
+        block.slice_batch_norm(net).eval()
+        images = torch.randn(3, 1, 256, 256)
+        with torch.no_grad():
+            logits = net(images)
+            for idx in range(len(images)):
+                for batchLogits, sliceLogits in zip(logits, net(images[idx : idx + 1])):
+                    torch.testing.assert_close(batchLogits[idx : idx + 1], sliceLogits, rtol=1e-4, atol=1e-4)
+
+    def test_fused_decoders_match_the_two_decoders(self):
+        torch.manual_seed(0)
+        net = swinv2Unet.SwinV2TwoDecoder(model_name="swinv2_cr_tiny_ns_224", img_size=(256, 256), in_chans=1)
+        for decoder in (net.deblock2_1, net.deblock2_4, net.conv2, net.outc2):  # decoders differing in weights only
+            for parameter in decoder.parameters():
+                parameter.data.normal_(std=0.1)
+
+        for sliceBatchNorm in (False, True):
+            if sliceBatchNorm:
+                block.slice_batch_norm(net)
+            net.eval()
+            fusedNet = swinv2Unet.FusedSwinV2TwoDecoder(net)
+            # Half as many decoder convolutions, the patch embedding one being shared
+            convolutions = [sum(isinstance(m, torch.nn.Conv2d) for m in model.modules()) for model in (net, fusedNet)]
+            self.assertEqual(convolutions[1] - 1, (convolutions[0] - 1) // 2)
+            for batchSize in (1, 3):
+                images = torch.randn(batchSize, 1, 256, 256)
+                with torch.no_grad():
+                    for logits, fusedLogits in zip(net(images), fusedNet(images)):
+                        torch.testing.assert_close(fusedLogits, logits, rtol=1e-4, atol=1e-4)
+
+        fusedNet = loadPKDIANet(self.weightsPath, "cpu", fused=True)
+        self.assertIsInstance(fusedNet, swinv2Unet.FusedSwinV2TwoDecoder)
+        self.assertFalse(any(tensor.is_meta for tensor in chain(fusedNet.parameters(), fusedNet.buffers())))
+
+    def test_auto_batch_size_fits_in_available_memory(self):
+        device = torch.device("cpu")
+        with mock.patch.object(utils, "get_available_memory", return_value=10 * utils.SLICE_MEMORY):
+            self.assertEqual(utils.auto_batch_size(device), 5)
+        with mock.patch.object(utils, "get_available_memory", return_value=1000 * utils.SLICE_MEMORY):
+            self.assertEqual(utils.auto_batch_size(device), 32)
+        with mock.patch.object(utils, "get_available_memory", return_value=utils.SLICE_MEMORY // 4):
+            self.assertEqual(utils.auto_batch_size(device), 1)
+        with mock.patch.object(utils, "get_available_memory", return_value=None):
+            self.assertEqual(utils.auto_batch_size(device), 4)
+
+    def test_model_registry_builds_each_model_once(self):
+        registry = ModelRegistry(maxSize=1)
+        init = swinv2Unet.SwinV2TwoDecoder.__init__
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "__init__", side_effect=init, autospec=True) as mockInit:
+            net = registry.get(ModalityEnum.T2, self.weightsPath, "cpu")
+            self.assertIs(registry.get(ModalityEnum.T2, self.weightsPath, "cpu"), net)
+            self.assertEqual(mockInit.call_count, 1)
+
+            inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 2, 4))
+            self._applyPKDIA(inputPath, ModalityEnum.T2, net=registry.get(ModalityEnum.T2, self.weightsPath, "cpu"))
+            self.assertEqual(mockInit.call_count, 1)
+
+            # Least recently used model is evicted once the registry is full
+            registry.get(ModalityEnum.CT, self.weightsPath, "cpu")
+            self.assertEqual(mockInit.call_count, 2)
+            self.assertEqual(len(registry), 1)
+            self.assertNotIn(ModelRegistry.key(ModalityEnum.T2, self.weightsPath, "cpu"), registry)
+
+            registry.release()
+            self.assertEqual(len(registry), 0)
+            registry.get(ModalityEnum.CT, self.weightsPath, "cpu")
+            self.assertEqual(mockInit.call_count, 3)
+
+    def test_model_is_loaded_without_pretrained_weights(self):
+        createModel = swinv2Unet.timm.create_model
+        with mock.patch.object(swinv2Unet.timm, "create_model", side_effect=createModel) as mockCreateModel:
+            net = loadPKDIANet(self.weightsPath, "cpu")
+        self.assertFalse(mockCreateModel.call_args.kwargs["pretrained"])
+
+        expected = swinv2Unet.SwinV2TwoDecoder(model_name="swinv2_cr_tiny_ns_224", img_size=(256, 256), in_chans=1)
+        expected.load_state_dict(torch.load(self.weightsPath, weights_only=True))
+        block.slice_batch_norm(expected).eval()
+
+        self.assertFalse(any(tensor.is_meta for tensor in chain(net.parameters(), net.buffers())))
+        expectedBuffers = dict(expected.named_buffers())
+        for name, buffer in net.named_buffers():
+            torch.testing.assert_close(buffer, expectedBuffers[name], rtol=0, atol=0, msg=name)
+
+        images = torch.randn(1, 1, 256, 256)
+        with torch.no_grad():
+            for logits, expectedLogits in zip(net(images), expected(images)):
+                torch.testing.assert_close(logits, expectedLogits, rtol=0, atol=0)
+
+    @pytest.mark.slow
+    def test_inference_is_about_twice_faster_than_legacy(self):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 8, 4))
+        self._applyPKDIA(inputPath, ModalityEnum.T2)  # warm-up
+
+        start = time.perf_counter()
+        legacyPredictions(str(inputPath), str(self.tempPath), ModalityEnum.T2, self.weightsPath)
+        legacyDuration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self._applyPKDIA(inputPath, ModalityEnum.T2)
+        duration = time.perf_counter() - start
+
+        self.assertLess(duration, 0.7 * legacyDuration)
@@ -0,0 +1,81 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import nibabel
+import numpy as np
+import pytest
+import torch
+from skimage.transform import resize
+from SlicerPKDIALib.pkdia.datasets.dataset_genkyst import tiny_dataset_genkyst_prod
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+from SlicerPKDIALib.pkdia.utils.utils import resize_stack
+
+from .TestUtils import createSyntheticVolume
+
+
+def slicePreprocessing(dataset):
+    """Reference per-slice preprocessing : skimage resize, rotate and rescale of every item of the dataset"""
+    return np.stack([dataset[idx][0] for idx in range(len(dataset))])
+
+
+class PreprocessingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _dataset(self, shape, modality):
+        inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=shape)
+        return tiny_dataset_genkyst_prod(str(inputPath), str(self.tempPath), 256, modality)
+
+    def test_resize_stack_matches_skimage_resize(self):
+        rng = np.random.default_rng(0)
+        for inputShape, outputShape in [((48, 40), (256, 256)), ((512, 300), (256, 256)), ((256, 256), (48, 400))]:
+            with self.subTest(inputShape=inputShape, outputShape=outputShape):
+                stack = rng.normal(100, 50, size=(3, *inputShape))
+                expected = np.stack([resize(img, outputShape, preserve_range=True) for img in stack])
+                np.testing.assert_allclose(resize_stack(stack, outputShape), expected, rtol=0, atol=1e-10)
+
+    def test_volume_preprocessing_matches_slice_preprocessing(self):
+        for shape, modality in [
+            ((48, 5, 40), ModalityEnum.T2),
+            ((320, 4, 280), ModalityEnum.T2),
+            ((300, 6, 5), ModalityEnum.CT),
+        ]:
+            with self.subTest(shape=shape, modality=modality):
+                dataset = self._dataset(shape, modality)
+                images = dataset.images()
+
+                self.assertEqual(images.dtype, torch.float32)
+                self.assertEqual(tuple(images.shape), (len(dataset), 1, 256, 256))
+                np.testing.assert_allclose(images.numpy(), slicePreprocessing(dataset), rtol=0, atol=1e-5)
+
+    def test_volume_preprocessing_of_a_slice_range(self):
+        dataset = self._dataset((48, 6, 40), ModalityEnum.T2)
+        np.testing.assert_array_equal(dataset.images(2, 5).numpy(), dataset.images()[2:5].numpy())
+
+    def test_constant_slices_are_preprocessed_like_skimage(self):
+        data = np.random.default_rng(0).normal(100, 10, size=(48, 3, 40))
+        data[:, 1, :] = 7
+        image = nibabel.Nifti1Image(data.astype(np.float32), affine=np.eye(4))
+        dataset = tiny_dataset_genkyst_prod(None, None, 256, ModalityEnum.T2, image=image)
+        np.testing.assert_allclose(dataset.images().numpy(), slicePreprocessing(dataset), rtol=0, atol=1e-5)
+
+    @pytest.mark.slow
+    def test_volume_preprocessing_is_faster_than_slice_preprocessing(self):
+        dataset = self._dataset((512, 32, 512), ModalityEnum.T2)
+        dataset.images(0, 1)  # warm-up
+
+        start = time.perf_counter()
+        slicePreprocessing(dataset)
+        sliceDuration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dataset.images()
+        duration = time.perf_counter() - start
+
+        self.assertLess(duration, sliceDuration)
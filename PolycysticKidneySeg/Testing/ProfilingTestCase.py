@@ -0,0 +1,91 @@
+import json
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.nets import swinv2Unet
+from SlicerPKDIALib.pkdia.profiling import STAGES, Profiler, profileStage
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+        self.inputPath = createSyntheticVolume(self.tempPath / "volume.nii.gz", shape=(48, 3, 4))
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_segmentation_stages_are_recorded_in_pipeline_order(self):
+        profiler = Profiler()
+        with profiler.activate(), mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            PKDIA.applyPKDIA(self.inputPath, self.tempPath / "output", ModalityEnum.T2, self.weightsPath, batchSize=2)
+        profiler.writeJson(self.tempPath / "profile.json")
+
+        with open(self.tempPath / "profile.json") as f:
+            stages = json.load(f)["stages"]
+        self.assertEqual([stage["stage"] for stage in stages], [name for name in STAGES if name != "Slicer import"])
+        calls = {stage["stage"]: stage["calls"] for stage in stages}
+        self.assertEqual(calls["forward"], 2)
+        self.assertEqual(calls["write"], 4)
+        for stage in stages:
+            self.assertGreater(stage["wallSeconds"], 0)
+            self.assertGreaterEqual(stage["cpuSeconds"], 0)
+            self.assertGreater(stage["peakBytes"], 0)
+            self.assertLessEqual(stage["peakIncreaseBytes"], stage["peakBytes"])
+        self.assertIn("forward: 2 calls", profiler.summary())
+
+        # deactivated profilers record nothing
+        with mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward):
+            PKDIA.applyPKDIA(self.inputPath, self.tempPath / "output", ModalityEnum.T2, self.weightsPath, batchSize=2)
+        self.assertEqual(profiler.stages["forward"].calls, 2)
+
+    def test_peak_memory_of_nested_stages(self):
+        profiler = Profiler()
+        with profiler.activate(), profileStage("post-process"):
+            with profileStage("connected components"):
+                array = np.ones(2**27, dtype=np.uint8)  # 128 MB, above the allocator threshold of fresh pages
+                del array
+            with profileStage("write"):
+                pass
+
+        stages = profiler.stages
+        self.assertGreater(stages["connected components"].peakBytes - stages["write"].peakBytes, 64 * 2**20)
+        self.assertGreaterEqual(stages["post-process"].peakBytes, stages["connected components"].peakBytes)
+        self.assertGreater(stages["connected components"].peakIncreaseBytes, 64 * 2**20)
+        self.assertLess(stages["write"].peakIncreaseBytes, 64 * 2**20)
+        self.assertGreaterEqual(
+            stages["post-process"].peakIncreaseBytes, stages["connected components"].peakIncreaseBytes
+        )
+
+    def test_stages_of_every_thread_are_recorded(self):
+        def write():
+            with profileStage("write"):
+                pass
+
+        profiler = Profiler()
+        with profiler.activate():
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join()
+        self.assertEqual(profiler.stages["write"].calls, 1)
+
+    def test_torch_profiler_trace_of_the_forward_stage(self):
+        profiler = Profiler(torchTracePath=self.tempPath / "trace.json")
+        with profiler.activate():
+            PKDIA.applyPKDIA(self.inputPath, self.tempPath / "output", ModalityEnum.T2, self.weightsPath, batchSize=2)
+        profiler.close()
+
+        with open(self.tempPath / "trace.json") as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(sum(event.get("name") == "PKDIA forward" for event in events), 2)
+        self.assertIn("Self CPU", profiler.summary())
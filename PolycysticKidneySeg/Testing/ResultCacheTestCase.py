@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+from SlicerPKDIALib.pkdia import PKDIA
+from SlicerPKDIALib.pkdia.cache import ResultCache
+from SlicerPKDIALib.pkdia.nets.registry import loadPKDIANet
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+        self.inputPath = createSyntheticVolume(self.tempPath / "exam.nii.gz", shape=(48, 5, 40))
+        self.cache = ResultCache(self.tempPath / "cache")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _applyPKDIAArray(self, modality=ModalityEnum.T2, **kwargs):
+        image = nibabel.load(self.inputPath)
+        kwargs = {"weightsPath": self.weightsPath, "net": self.net, "cache": self.cache, **kwargs}
+        return PKDIA.applyPKDIAArray(image.get_fdata(dtype=np.float32), image.affine, modality, **kwargs)
+
+    def test_masks_are_stored_packed_and_read_back(self):
+        rng = np.random.default_rng(0)
+        masks = [(rng.random((7, 5, 3)) > 0.5).astype(np.uint8) for _ in range(2)]
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.put("key", *masks)
+        for mask, cachedMask in zip(masks, self.cache.get("key")):
+            np.testing.assert_array_equal(cachedMask, mask)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        self.cache.put("large", *[np.ones((64, 64, 64), np.uint8)] * 2)
+        self.assertLess(os.path.getsize(self.tempPath / "cache" / "large.npz"), 64**3 // 8)
+
+    def test_least_recently_used_predictions_are_evicted(self):
+        masks = [np.random.default_rng(0).random((32, 32, 32)) > 0.5] * 2
+        self.cache.put("first", *masks)
+        entrySize = os.path.getsize(self.tempPath / "cache" / "first.npz")
+        self.cache.maxBytes = 2 * entrySize + entrySize // 2
+
+        self.cache.put("second", *masks)
+        os.utime(self.tempPath / "cache" / "first.npz", (0, 0))
+        os.utime(self.tempPath / "cache" / "second.npz", (1, 1))
+        self.assertIsNotNone(self.cache.get("first"))  # now the most recently used
+        self.cache.put("third", *masks)
+
+        self.assertIsNone(self.cache.get("second"))
+        self.assertIsNotNone(self.cache.get("first"))
+        self.assertIsNotNone(self.cache.get("third"))
+
+    def test_cached_predictions_skip_inference(self):
+        self.net = loadPKDIANet(self.weightsPath, "cpu")
+        forward = mock.Mock(side_effect=lambda x: sliceWiseForward(None, x))
+        with mock.patch.object(self.net, "forward", forward):
+            expected = self._applyPKDIAArray(cache=None)
+            calls = forward.call_count
+            self.assertTrue(expected[0].any())
+
+            for array, expectedArray in zip(self._applyPKDIAArray(), expected):
+                np.testing.assert_array_equal(array, expectedArray)
+            self.assertEqual(forward.call_count, 2 * calls)
+            self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+            progressCallback = mock.Mock()
+            for array, expectedArray in zip(self._applyPKDIAArray(progressCallback=progressCallback), expected):
+                np.testing.assert_array_equal(array, expectedArray)
+            self.assertEqual(forward.call_count, 2 * calls)
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+            progressCallback.assert_called_once_with(5, 5)
+
+            # The file API shares the cache, predictions depending on the exam content rather than on its origin
+            outputDir = self.tempPath / "output"
+            paths = PKDIA.applyPKDIA(
+                str(self.inputPath), str(outputDir), ModalityEnum.T2, self.weightsPath, net=self.net, cache=self.cache
+            )
+            self.assertEqual(forward.call_count, 2 * calls)
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+
+            # Any change of the voxels, modality, options or weights is a miss
+            self._applyPKDIAArray(ModalityEnum.CT)
+            self._applyPKDIAArray(localizerStride=2)
+            createRandomWeights(self.weightsPath, seed=1)
+            self._applyPKDIAArray()
+            self.inputPath = createSyntheticVolume(self.tempPath / "exam.nii.gz", shape=(48, 5, 40), seed=1)
+            self._applyPKDIAArray()
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 5))
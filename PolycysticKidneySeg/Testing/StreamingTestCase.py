@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import nibabel
+import numpy as np
+import torch
+from SlicerPKDIALib.pkdia import PKDIA, streaming
+from SlicerPKDIALib.pkdia.nets import swinv2Unet
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+from SlicerPKDIALib.pkdia.utils.utils import SLICE_MEMORY, getLargestConnectedArea
+
+from .PKDIATestCase import sliceWiseForward
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class StreamingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_streamed_predictions_match_applyPKDIA(self):
+        image = nibabel.load(createSyntheticVolume(self.tempPath / "canonical.nii.gz", shape=(48, 9, 40)))
+        inputPath = self.tempPath / "volume.nii.gz"
+        nibabel.save(image.as_reoriented(np.array([[1, -1], [2, 1], [0, -1]])), inputPath)
+
+        for modality in ModalityEnum:
+            with self.subTest(modality=modality), mock.patch.object(
+                swinv2Unet.SwinV2TwoDecoder, "forward", sliceWiseForward
+            ), mock.patch.object(streaming, "planSlabs", return_value=(4, 2)):
+                expectedPaths = PKDIA.applyPKDIA(inputPath, self.tempPath / "memory", modality, self.weightsPath)
+                paths = streaming.applyPKDIAStreaming(
+                    inputPath, self.tempPath / "streamed", modality, self.weightsPath, 2**30
+                )
+
+                for expectedPath, path in zip(expectedPaths, paths):
+                    expected, streamed = nibabel.load(expectedPath), nibabel.load(path)
+                    np.testing.assert_array_equal(np.asanyarray(streamed.dataobj), np.asanyarray(expected.dataobj))
+                    np.testing.assert_allclose(streamed.affine, expected.affine)
+                    self.assertEqual(streamed.header, expected.header)
+                self.assertEqual(sorted(os.listdir(self.tempPath / "streamed")), sorted(map(os.path.basename, paths)))
+
+    def test_localizer_pass_runs_once_over_the_exam(self):
+        def midRangeForward(_, x):
+            """kidneys where slices are above their mid-range, none in constant slices"""
+            midRange = (x.amax(dim=(1, 2, 3), keepdim=True) + x.amin(dim=(1, 2, 3), keepdim=True)) / 2
+            return x - midRange - 1e-3, x.flip(-1) - midRange - 1e-3
+
+        data = np.zeros((48, 40, 40), dtype=np.int16)
+        data[10:38, 18:24, 10:30] = np.random.default_rng(0).normal(100, 10, size=(28, 6, 20))
+        inputPath = self.tempPath / "volume.nii.gz"
+        nibabel.save(nibabel.Nifti1Image(data, np.diag([0.8, 2.0, 0.8, 1.0])), inputPath)
+
+        forward = mock.patch.object(swinv2Unet.SwinV2TwoDecoder, "forward", side_effect=midRangeForward, autospec=True)
+        slab = mock.patch.object(streaming.StreamedExam, "slab", side_effect=streaming.StreamedExam.slab, autospec=True)
+        with forward as mockForward:
+            expectedPaths = PKDIA.applyPKDIA(
+                inputPath, self.tempPath / "memory", ModalityEnum.T2, self.weightsPath, localizerStride=4
+            )
+            expectedSlices = sum(len(call.args[1]) for call in mockForward.call_args_list)
+            mockForward.reset_mock()
+            with mock.patch.object(streaming, "planSlabs", return_value=(4, 2)), slab as mockSlab:
+                paths = streaming.applyPKDIAStreaming(
+                    inputPath, self.tempPath / "streamed", ModalityEnum.T2, self.weightsPath, 2**30, localizerStride=4
+                )
+            streamedSlices = sum(len(call.args[1]) for call in mockForward.call_args_list)
+
+        self.assertLess(expectedSlices, 40)
+        self.assertEqual(streamedSlices, expectedSlices)
+        self.assertLess(mockSlab.call_count, 10 + 10 + 10)  # normalization, coarse pass, slabs around the kidneys
+        for expectedPath, path in zip(expectedPaths, paths):
+            np.testing.assert_array_equal(
+                np.asanyarray(nibabel.load(path).dataobj), np.asanyarray(nibabel.load(expectedPath).dataobj)
+            )
+
+    def test_largest_connected_area_across_slabs(self):
+        mask = (np.random.default_rng(0).random((20, 17, 15)) < 0.3).astype(np.uint8)
+        expected = getLargestConnectedArea(mask)
+        for slabSlices in (1, 4, 17):
+            slabs = [slice(start, min(start + slabSlices, 17)) for start in range(0, 17, slabSlices)]
+            release = mock.Mock()
+            np.testing.assert_array_equal(streaming.largestConnectedArea(mask.copy(), slabs, release), expected)
+            self.assertEqual(release.call_count, 2 * len(slabs))
+
+        empty = np.zeros((4, 5, 6), dtype=np.uint8)
+        self.assertFalse(streaming.largestConnectedArea(empty, [slice(0, 2), slice(2, 5)]).any())
+
+    def test_slabs_fit_the_memory_budget(self):
+        cpu, sliceVoxels = torch.device("cpu"), 512 * 512
+        with mock.patch.object(streaming, "get_resident_memory", return_value=2**30):
+            slabSlices, batchSize = streaming.planSlabs(3 * 2**30, sliceVoxels, 400, cpu)
+            self.assertEqual(batchSize, 2**30 // SLICE_MEMORY)
+            slabMemory = slabSlices * sliceVoxels * streaming.SLAB_VOXEL_MEMORY
+            self.assertLessEqual(2**30 + batchSize * SLICE_MEMORY + slabMemory, 3 * 2**30)
+            self.assertGreater(slabSlices, 1)
+
+            self.assertEqual(streaming.planSlabs(3 * 2**30, 64 * 64, 20, cpu), (20, batchSize))
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(streaming.planSlabs(2**30, sliceVoxels, 400, cpu), (1, 1))
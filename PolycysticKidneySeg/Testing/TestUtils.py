@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import nibabel
+import numpy as np
+import torch
+
+
+def createSyntheticVolume(filePath, shape=(48, 4, 40), spacing=(0.8, 2.0, 0.8), seed=0):
+    """
+    Writes a NIfTI volume with two bright ellipsoids (kidney-like blobs) on a noisy background and returns its path.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij", sparse=True)
+    data = rng.normal(100, 10, size=shape)
+    for center in (-0.5, 0.5):
+        blob = ((grid[0] - center) / 0.3) ** 2 + (grid[1] / 0.9) ** 2 + (grid[2] / 0.5) ** 2 <= 1
+        data[blob] += 300
+
+    affine = np.diag([*spacing, 1.0])
+    filePath = Path(filePath)
+    nibabel.save(nibabel.Nifti1Image(data.astype(np.int16), affine=affine), filePath)
+    return filePath
+
+
+def createRandomWeights(filePath, seed=0):
+    """
+    Writes a randomly initialized SwinV2TwoDecoder state dict with the PKDIA architecture and returns its path.
+    """
+    from SlicerPKDIALib.pkdia.nets import swinv2Unet
+
+    torch.manual_seed(seed)
+    net = swinv2Unet.SwinV2TwoDecoder(
+        model_name="swinv2_cr_tiny_ns_224",
+        pretrained=False,
+        img_size=(256, 256),
+        in_chans=1,
+        n_classes_1dec=1,
+        n_classes_2dec=1,
+    )
+    filePath = Path(filePath)
+    torch.save(net.state_dict(), filePath)
+    return filePath
@@ -0,0 +1,107 @@
+import io
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+from SlicerPKDIALib.pkdia import validation
+from SlicerPKDIALib.pkdia.nets import registry as netRegistry
+from SlicerPKDIALib.pkdia.nets.registry import (
+    QUANTIZED_STAGES,
+    ModelRegistry,
+    loadPKDIANet,
+    precisionDtype,
+)
+from SlicerPKDIALib.pkdia.utils.modality import ModalityEnum
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from .TestUtils import createRandomWeights, createSyntheticVolume
+
+
+class ValidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempPath = Path(self.tempDir.name)
+        self.weightsPath = createRandomWeights(self.tempPath / "weights.pth")
+        self.inputPath = createSyntheticVolume(self.tempPath / "exam.nii.gz", shape=(48, 3, 4))
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_dice_and_volume_change(self):
+        mask = np.zeros((4, 4), np.uint8)
+        referenceMask = np.zeros((4, 4), np.uint8)
+        self.assertEqual(validation.dice(mask, referenceMask), 1.0)
+        self.assertEqual(validation.volumeChange(mask, referenceMask), 0.0)
+
+        mask[:2, :2] = 1
+        referenceMask[:2, :] = 1
+        self.assertAlmostEqual(validation.dice(mask, referenceMask), 2 * 4 / (4 + 8))
+        self.assertAlmostEqual(validation.volumeChange(mask, referenceMask), -50.0)
+
+    def test_precision_names(self):
+        self.assertEqual(precisionDtype("bf16"), torch.bfloat16)
+        self.assertEqual(precisionDtype(torch.float16), torch.float16)
+        with self.assertRaises(ValueError):
+            precisionDtype("int4")
+
+        self.assertEqual(
+            ModelRegistry.key(ModalityEnum.T2, self.weightsPath, "cpu", "bf16"),
+            ModelRegistry.key(ModalityEnum.T2, self.weightsPath, "cpu", torch.bfloat16),
+        )
+        net = loadPKDIANet(self.weightsPath, device="cpu", dtype="bf16")
+        self.assertTrue(all(parameter.dtype == torch.bfloat16 for parameter in net.parameters()))
+
+    def test_int8_network(self):
+        net = loadPKDIANet(self.weightsPath, device="cpu", dtype="int8")
+        for name in QUANTIZED_STAGES:
+            stage = getattr(net, name)
+            self.assertFalse(any(isinstance(module, torch.nn.Linear) for module in stage.modules()))
+            self.assertTrue(any(isinstance(module, DynamicQuantizedLinear) for module in stage.modules()))
+        self.assertEqual(next(net.parameters()).dtype, torch.float32)
+
+        # Only the linear layers are approximated : the logits stay close to the float32 ones
+        referenceNet = loadPKDIANet(self.weightsPath, device="cpu")
+        images = torch.randn(2, 1, 256, 256)
+        with torch.inference_mode():
+            for logits, referenceLogits in zip(net(images), referenceNet(images)):
+                self.assertGreater(((logits > 0) == (referenceLogits > 0)).float().mean().item(), 0.99)
+
+        with self.assertRaises(ValueError):
+            loadPKDIANet(self.weightsPath, device="cuda", dtype="int8")
+
+        registry = ModelRegistry()
+        self.assertIs(
+            registry.get(ModalityEnum.T2, self.weightsPath, "cpu", "int8"),
+            registry.get(ModalityEnum.T2, self.weightsPath, "cpu", torch.qint8),
+        )
+        self.assertEqual(len(registry), 1)
+
+    def test_compare_precisions(self):
+        rows = validation.comparePrecisions([self.inputPath], ModalityEnum.T2, self.weightsPath, ("bf16", "int8"), 4)
+        self.assertEqual([row["variant"] for row in rows], ["bf16", "int8"])
+        for row in rows:
+            self.assertEqual(set(row), set(validation.VALIDATION_FIELDS))
+            for kidney in ("LK", "RK"):
+                self.assertGreaterEqual(row[f"dice_{kidney}"], 0.0)
+                self.assertLessEqual(row[f"dice_{kidney}"], 1.0)
+
+        output = io.StringIO()
+        validation.writeRows(rows, output)
+        self.assertTrue(output.getvalue().startswith(",".join(validation.VALIDATION_FIELDS)))
+
+    def test_int8_network_is_compared_on_cpu_on_other_devices(self):
+        meta = torch.device("meta")  # stands for a GPU, networks being built without running them
+        with mock.patch.object(netRegistry, "default_device", return_value=meta), mock.patch.object(
+            validation, "compareNetworks"
+        ) as mockCompare:
+            validation.comparePrecisions([self.inputPath], ModalityEnum.T2, self.weightsPath)
+
+        _, _, referenceNet, nets, _ = mockCompare.call_args.args
+        self.assertEqual(next(referenceNet.parameters()).device, meta)
+        self.assertEqual(
+            {precision: next(net.parameters()).device.type for precision, net in nets.items()},
+            {"bf16": "meta", "fp16": "meta", "int8": "cpu"},
+        )
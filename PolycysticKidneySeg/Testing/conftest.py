@@ -0,0 +1,4 @@
+import importlib.util
+
+# IntegrationTestCase needs the Slicer application, the other test cases run in any Python environment
+collect_ignore = [] if importlib.util.find_spec("slicer") is not None else ["IntegrationTestCase.py"]